@@ -0,0 +1,87 @@
+"""Benchmark of training step time and peak memory with and without activation checkpointing (checkpoint_stages).
+
+Runs train_one_epoch of resunet.py / transunet.py on a synthetic batch, each configuration in a fresh
+process, and reports the peak memory the same way as amp_training.py: peak allocated memory on CUDA, the
+growth of the peak resident set size over a warm-up step on CPU (mostly activations).
+
+Usage:
+    python benchmarks/activation_checkpointing.py [--models resunet transunet] [--base-channels 32] [--depth 4]
+                                                  [--image-size 256] [--batch-size 2] [--steps 3] [--device cpu]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from amp_training import ROOT, MODELS, load_notebook, peak_rss
+
+CONFIGURATIONS = {"none": (), "stage 0": (0,), "stages 0-1": (0, 1), "all": True}
+
+
+def run(args):
+    # One model and configuration, in this process; prints a JSON result line
+    file_name, constructor = MODELS[args.model]
+    notebook = load_notebook(os.path.join(ROOT, file_name))
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = eval(constructor.format(base_channels=args.base_channels, depth=args.depth), vars(notebook)).to(device)
+    model.checkpoint_stages = set(range(args.depth)) if args.stages == "all" else {int(s) for s in args.stages.split(",") if s}
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    criterion = notebook.CombinedLoss()
+    size = args.image_size
+    images = torch.randn(args.batch_size, 9, size, size)
+    labels = (torch.rand(args.batch_size, size, size) > 0.95).long()
+    loader = DataLoader(TensorDataset(images, labels), batch_size=args.batch_size)
+
+    notebook.train_one_epoch(model, loader, optimizer, criterion, device)  # Warm-up, allocates the optimizer state
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    baseline = peak_rss()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        notebook.train_one_epoch(model, loader, optimizer, criterion, device)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        peak = peak_rss() - baseline
+    step_time = (time.perf_counter() - start) / args.steps
+    print(json.dumps({"step_time": step_time, "peak_memory": peak}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--models', nargs='+', choices=["resunet", "transunet"], default=["resunet", "transunet"])
+    parser.add_argument('--base-channels', type=int, default=32)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--image-size', type=int, default=256)
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--device', default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--model', choices=list(MODELS), help=argparse.SUPPRESS)
+    parser.add_argument('--stages', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.model:
+        return run(args)
+
+    print(f"{args.device}, base_channels={args.base_channels}, depth={args.depth}, batch {args.batch_size} x 9 x {args.image_size} x {args.image_size}")
+    print(f"{'model':<12}{'checkpointed':<14}{'step (s)':>10}{'peak (MiB)':>12}")
+    for model in args.models:
+        for name, stages in CONFIGURATIONS.items():
+            stages = "all" if stages is True else ",".join(map(str, stages))
+            command = [sys.executable, __file__, "--model", model, "--stages", stages,
+                       "--base-channels", str(args.base_channels), "--depth", str(args.depth),
+                       "--image-size", str(args.image_size), "--batch-size", str(args.batch_size),
+                       "--steps", str(args.steps), "--device", args.device]
+            result = json.loads(subprocess.run(command, check=True, capture_output=True, text=True).stdout.splitlines()[-1])
+            print(f"{model:<12}{name:<14}{result['step_time']:>10.3f}{result['peak_memory'] / 2**20:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Benchmark of training step time and peak memory in float32 versus mixed precision (train_one_epoch(amp=True)).
+
+The model classes, losses and train_one_epoch are taken from the model notebooks themselves (their
+definitions are executed, not the Colab training script). Each model and precision runs in a fresh process
+on a synthetic batch, so the peak memory of one does not hide the other: on CUDA it is the peak allocated
+memory, on CPU the growth of the peak resident set size over a warm-up step, after which the weights,
+gradients and optimizer state are allocated, i.e. mostly the activations. Mixed precision is float16 with a gradient scaler on CUDA
+and bfloat16 on CPU, see amp_dtype in the notebooks.
+
+The UNet of unet.py builds its blocks from an external layer_factory module, so it is not included; UNetPlusPlus
+has fixed widths and ignores --base-channels and --depth. At base_channels=128 and depth=4, ResidualUNet has about
+305M parameters and needs about 5 GB for the float32 weights, gradients and Adam state alone.
+
+Usage:
+    python benchmarks/amp_training.py [--models resunet transunet] [--base-channels 128] [--depth 4]
+                                      [--image-size 128] [--batch-size 4] [--steps 5] [--device cpu]
+"""
+import argparse
+import ast
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import types
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODELS = {
+    "unetplusplus": ("unetplusplus.py", "UNetPlusPlus(9, 2)"),
+    "resunet": ("resunet.py", "ResidualUNet(c_in=9, c_out=2, base_channels={base_channels}, depth={depth})"),
+    "transunet": ("transunet.py", "TransUNet(c_in=9, c_out=2, base_channels={base_channels}, depth={depth})"),
+}
+
+
+def load_notebook(path):
+    # Executes only the imports, classes, functions and ALL_CAPS constants of a notebook script
+    source = "\n".join(line for line in open(path).read().splitlines() if not line.lstrip().startswith("!"))
+    keep = [node for node in ast.parse(source).body
+            if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef))
+            and not (isinstance(node, ast.ImportFrom) and node.module and node.module.startswith("google"))
+            or isinstance(node, ast.Assign) and all(isinstance(t, ast.Name) and t.id.isupper() for t in node.targets)]
+    module = types.ModuleType(os.path.basename(path)[:-3])
+    sys.modules[module.__name__] = module
+    exec(compile(ast.Module(body=keep, type_ignores=[]), path, "exec"), module.__dict__)
+    return module
+
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KiB on Linux
+
+
+def run(args):
+    # One model and precision, in this process; prints a JSON result line
+    file_name, constructor = MODELS[args.model]
+    notebook = load_notebook(os.path.join(ROOT, file_name))
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = eval(constructor.format(base_channels=args.base_channels, depth=args.depth), vars(notebook)).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    criterion = notebook.CombinedLoss()
+    scaler = notebook.make_grad_scaler(device, args.amp)
+    size = args.image_size
+    images = torch.randn(args.batch_size, 9, size, size)
+    labels = (torch.rand(args.batch_size, size, size) > 0.95).long()
+    loader = DataLoader(TensorDataset(images, labels), batch_size=args.batch_size)
+
+    notebook.train_one_epoch(model, loader, optimizer, criterion, device, amp=args.amp, scaler=scaler)  # Warm-up, allocates the optimizer state
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    baseline = peak_rss()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        notebook.train_one_epoch(model, loader, optimizer, criterion, device, amp=args.amp, scaler=scaler)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        peak = peak_rss() - baseline
+    step_time = (time.perf_counter() - start) / args.steps
+    print(json.dumps({"step_time": step_time, "peak_memory": peak}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--models', nargs='+', choices=list(MODELS), default=["resunet", "transunet"])
+    parser.add_argument('--base-channels', type=int, default=128)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--image-size', type=int, default=128)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--device', default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--model', choices=list(MODELS), help=argparse.SUPPRESS)
+    parser.add_argument('--amp', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.model:
+        return run(args)
+
+    print(f"{args.device}, base_channels={args.base_channels}, depth={args.depth}, batch {args.batch_size} x 9 x {args.image_size} x {args.image_size}")
+    print(f"{'model':<14}{'precision':<11}{'step (s)':>10}{'peak (MiB)':>12}")
+    for model in args.models:
+        for amp in (False, True):
+            command = [sys.executable, __file__, "--model", model, "--base-channels", str(args.base_channels), "--depth", str(args.depth),
+                       "--image-size", str(args.image_size), "--batch-size", str(args.batch_size),
+                       "--steps", str(args.steps), "--device", args.device] + (["--amp"] if amp else [])
+            result = json.loads(subprocess.run(command, check=True, capture_output=True, text=True).stdout.splitlines()[-1])
+            precision = "float32" if not amp else "float16" if args.device.startswith("cuda") else "bfloat16"
+            print(f"{model:<14}{precision:<11}{result['step_time']:>10.3f}{result['peak_memory'] / 2**20:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Micro-benchmark of DataLoader throughput with per-sample versus batched (collate-stage) augmentation.
+
+Both pipelines apply the same augmentation: a random flip / 90 degree rotation and a per-band gain. The
+per-sample one runs it as the dataset transform, once per sample in Python; the batched one is
+BatchAugment.collate, loaded from a model notebook, which stacks, flips and jitters all samples sharing a
+transform at once. Samples are synthetic in-memory tensors, so only the augmentation and collation overhead
+is measured.
+
+Usage:
+    python benchmarks/batch_augment.py [--batch-size 64] [--patch-size 128] [--channels 9] [--num-workers 0]
+                                       [--notebook resunet.py]
+"""
+import argparse
+import os
+import time
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from amp_training import ROOT, load_notebook
+
+
+class RandomPatches(Dataset):
+    def __init__(self, num_samples, channels, patch_size, transform=None):
+        self.images = torch.randn(num_samples, channels, patch_size, patch_size)
+        self.labels = (torch.rand(num_samples, patch_size, patch_size) > 0.9).long()
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        image, label = self.images[idx], self.labels[idx]
+        if self.transform:
+            image, label = self.transform(image, label)
+        return image, label
+
+
+def per_sample_augment(image, label, spectral_gain=0.05):
+    k = int(torch.randint(4, ()))
+    image, label = torch.rot90(image, k, (-2, -1)), torch.rot90(label, k, (-2, -1))
+    if torch.rand(()) < 0.5:
+        image, label = image.flip(-1), label.flip(-1)
+    image = image * (1 + spectral_gain * torch.randn(image.shape[0], 1, 1))
+    return image, label
+
+
+def throughput(loader, epochs=3):
+    for _ in loader:  # Warm-up epoch, also starts the workers
+        pass
+    start = time.perf_counter()
+    samples = 0
+    for _ in range(epochs):
+        for images, _ in loader:
+            samples += images.shape[0]
+    return samples / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--num-samples', type=int, default=1024)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--patch-size', type=int, default=128)
+    parser.add_argument('--channels', type=int, default=9)
+    parser.add_argument('--num-workers', type=int, default=0)
+    parser.add_argument('--notebook', default="resunet.py", help="Model notebook to take BatchAugment from")
+    args = parser.parse_args()
+    torch.set_num_threads(1)  # Like a DataLoader worker
+    augment = load_notebook(os.path.join(ROOT, args.notebook)).BatchAugment(p_flip=0.5, p_transpose=0.5, spectral_gain=0.05)
+
+    loaders = {
+        "per-sample": DataLoader(RandomPatches(args.num_samples, args.channels, args.patch_size, per_sample_augment),
+                                 batch_size=args.batch_size, num_workers=args.num_workers),
+        "batched": DataLoader(RandomPatches(args.num_samples, args.channels, args.patch_size),
+                              batch_size=args.batch_size, num_workers=args.num_workers, collate_fn=augment.collate),
+    }
+    print(f"{args.batch_size} x {args.channels} x {args.patch_size} x {args.patch_size}, {args.num_workers} workers")
+    for name, loader in loaders.items():
+        print(f"{name:<12}{throughput(loader):>10.0f} samples/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Micro-benchmark of the per-item and worker-startup overhead of STARCOPDataset's ID lookup.
+
+Compares the old lookup, a DataFrame kept on the dataset with df.iloc[idx]['id'] and two os.path.join
+calls per item, against STARCOPDataset itself, loaded from a model notebook, which keeps a NumPy array of
+the IDs and builds the paths in _paths. No data files are read, so only the bookkeeping overhead is measured.
+
+Usage:
+    python benchmarks/dataset_overhead.py [--num-scenes 10000] [--num-items 20000] [--notebook resunet.py]
+"""
+import argparse
+import os
+import pickle
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from amp_training import ROOT, load_notebook
+
+
+class DataFrameLookup:
+    """The old STARCOPDataset bookkeeping: the whole DataFrame is kept and queried per item."""
+    def __init__(self, df, preprocessed_dir):
+        self.df = df
+        self.preprocessed_dir = preprocessed_dir
+
+    def paths(self, idx):
+        image_id = self.df.iloc[idx]['id']
+        image_path = os.path.join(self.preprocessed_dir, f"{image_id}_image.npy")
+        label_path = os.path.join(self.preprocessed_dir, f"{image_id}_label.npy")
+        return image_path, label_path
+
+
+def benchmark(lookup, paths, num_scenes, num_items, rng):
+    indices = rng.integers(0, num_scenes, size=num_items)
+    start = time.perf_counter()
+    for idx in indices:
+        paths(idx)
+    per_item_us = (time.perf_counter() - start) / num_items * 1e6
+
+    # What every DataLoader worker receives, and how long it takes to rebuild
+    payload = pickle.dumps(lookup)
+    start = time.perf_counter()
+    pickle.loads(payload)
+    unpickle_ms = (time.perf_counter() - start) * 1e3
+    return per_item_us, len(payload) / 1e6, unpickle_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--num-scenes', type=int, default=10000)
+    parser.add_argument('--num-items', type=int, default=20000)
+    parser.add_argument('--notebook', default="resunet.py", help="Model notebook to take STARCOPDataset from")
+    args = parser.parse_args()
+    notebook = load_notebook(os.path.join(ROOT, args.notebook))
+
+    # A CSV shaped like the STARCOP ones: an ID plus a handful of metadata columns
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'id': [f"ang2019{i:04d}t{i % 1000:06d}_r{i % 7}_c{i % 11}" for i in range(args.num_scenes)],
+        'difficulty': rng.choice(['easy', 'hard'], size=args.num_scenes),
+        'qplume': rng.random(args.num_scenes),
+        'has_plume': rng.random(args.num_scenes) > 0.5,
+    })
+    preprocessed_dir = "/content/STARCOP_train_easy"
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_file = os.path.join(tmp, "train.csv")
+        df.to_csv(csv_file, index=False)
+        dataset = notebook.STARCOPDataset(csv_file=csv_file, preprocessed_dir=preprocessed_dir)
+
+    print(f"{args.num_scenes} scenes, {args.num_items} lookups")
+    print(f"{'lookup':<12}{'per item us':>14}{'pickled MB':>14}{'unpickle ms':>14}")
+    old = DataFrameLookup(df, preprocessed_dir)
+    for name, lookup, paths in (("dataframe", old, old.paths), ("dataset", dataset, dataset._paths)):
+        per_item_us, pickled_mb, unpickle_ms = benchmark(lookup, paths, args.num_scenes, args.num_items, rng)
+        print(f"{name:<12}{per_item_us:>14.2f}{pickled_mb:>14.3f}{unpickle_ms:>14.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -14,62 +14,970 @@ import pandas as pd  # For data manipulation and analysis
 import os  # For interacting with the operating system
 import rasterio  # For working with raster data
 import numpy as np  # For numerical operations
+import json  # For reading and writing the preprocessing manifest
+import hashlib  # For hashing source files
+import time  # For timing the preprocessing stages
+import threading  # For timing band reads from several threads
+from contextlib import contextmanager, ExitStack  # For the stage timer context manager and closing the band files
 from tqdm import tqdm  # For creating progress bars during loops
+from scipy import ndimage  # For finding connected plume components
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor  # For converting scenes and reading bands in parallel
 
-def preprocess_data(csv_file, root_dir, output_dir):
+# List of band file names, the default band set of preprocess_data
+BAND_FILES = [
+    "TOA_AVIRIS_460nm.tif",
+    "TOA_AVIRIS_550nm.tif",
+    "TOA_AVIRIS_640nm.tif",
+    "TOA_AVIRIS_2004nm.tif",
+    "TOA_AVIRIS_2109nm.tif",
+    "TOA_AVIRIS_2310nm.tif",
+    "TOA_AVIRIS_2350nm.tif",
+    "TOA_AVIRIS_2360nm.tif",
+    "mag1c.tif"
+]
+LABEL_FILE = "labelbinary.tif"
+
+# Per-output-directory record of converted scenes, used to skip unchanged scenes on rerun
+MANIFEST_FILE = "manifest.jsonl"
+
+# Per-output-directory per-band normalisation statistics
+STATS_FILE = "band_stats.json"
+
+# Per-output-directory index of the plumes (connected components) in every label
+PLUME_INDEX_FILE = "plume_index.npz"
+
+# Band whose hotspots (its brightest pixels in a scene) are indexed next to the plumes
+MAG1C_FILE = "mag1c.tif"
+MAG1C_HOTSPOT_QUANTILE = 0.999
+
+class StageTimer:
+    """
+    Accumulates wall time per preprocessing stage and bytes read / written for one scene.
+
+    Stages timed inside band-reading threads are summed over the threads, so with band_threads > 1
+    "open" and "decode" can exceed the wall time of the enclosing "read" stage.
+    """
+    def __init__(self):
+        self.seconds = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+
+    def add_read(self, path):
+        with self._lock:
+            self.bytes_read += os.path.getsize(path)
+
+    def add_written(self, path):
+        with self._lock:
+            self.bytes_written += os.path.getsize(path)
+
+    def __getstate__(self):
+        # Locks cannot be pickled back from worker processes
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+def timing_report(timers, wall_seconds):
+    """
+    Summarises the StageTimers of a preprocessing run.
+
+    Args:
+        timers (list): One StageTimer per processed scene.
+        wall_seconds (float): Wall time of the whole run.
+
+    Returns:
+        dict: Scenes, wall time, scenes/s, MB read / written and MB/s, and per stage the total, p50 and p95
+            seconds per scene.
+    """
+    mb_read = sum(t.bytes_read for t in timers) / 1e6
+    mb_written = sum(t.bytes_written for t in timers) / 1e6
+    wall_seconds = max(wall_seconds, 1e-9)
+    stages = {}
+    for name in sorted({name for t in timers for name in t.seconds}):
+        seconds = np.array([t.seconds.get(name, 0.0) for t in timers])
+        stages[name] = {
+            "total_s": float(seconds.sum()),
+            "p50_s": float(np.percentile(seconds, 50)),
+            "p95_s": float(np.percentile(seconds, 95)),
+        }
+    return {
+        "scenes": len(timers),
+        "wall_s": wall_seconds,
+        "scenes_per_s": len(timers) / wall_seconds,
+        "mb_read": mb_read,
+        "mb_written": mb_written,
+        "read_mb_per_s": mb_read / wall_seconds,
+        "write_mb_per_s": mb_written / wall_seconds,
+        "stages": stages,
+    }
+
+def print_timing_report(report):
+    """
+    Prints a timing_report as a small table.
+
+    Args:
+        report (dict): Output of timing_report.
+    """
+    print(f"{report['scenes']} scenes in {report['wall_s']:.1f} s ({report['scenes_per_s']:.2f} scenes/s), "
+          f"read {report['mb_read']:.1f} MB ({report['read_mb_per_s']:.1f} MB/s), "
+          f"wrote {report['mb_written']:.1f} MB ({report['write_mb_per_s']:.1f} MB/s)")
+    print(f"{'stage':<12}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, stage in report['stages'].items():
+        print(f"{name:<12}{stage['total_s']:>10.2f}{stage['p50_s'] * 1e3:>10.1f}{stage['p95_s'] * 1e3:>10.1f}")
+
+def read_bands(folder_path, band_files=BAND_FILES, band_threads=1, timer=None):
+    """
+    Reads the band files of a scene into a preallocated (num_bands, H, W) array.
+
+    Each band is decoded straight into its slice of the output array, so there is no
+    intermediate list of bands and no extra copy from np.stack. GDAL releases the GIL
+    while decoding, so with band_threads > 1 the band reads overlap, which hides most of
+    the I/O latency on network storage. Bands of different dtypes are widened to the dtype
+    they all fit in (np.result_type), as np.stack did; bands of different shapes are
+    rejected.
+
+    Args:
+        folder_path (str): Path to the scene folder.
+        band_files (list): Band file names to read, in channel order.
+        band_threads (int): Number of threads used to read the bands concurrently.
+        timer (StageTimer, optional): Records "open" and "decode" time and the bytes read.
+
+    Returns:
+        np.ndarray: Multi-band image with shape (num_bands, H, W).
+    """
+    timer = timer or StageTimer()
+    file_paths = [os.path.join(folder_path, file_name) for file_name in band_files]
+
+    with ExitStack() as stack:
+        def open_band(path):
+            with timer.stage("open"):
+                return stack.enter_context(rasterio.open(path))
+
+        def read_band(i):
+            with timer.stage("decode"):
+                sources[i].read(1, out=image[i], out_dtype=image.dtype) # Read the first band of the image in place
+            timer.add_read(file_paths[i])
+
+        # Open every band first, so the output array can take the dtype all bands fit in, as np.stack would.
+        # The files are opened and closed in this thread, as rasterio ties each open file to its thread's GDAL
+        # environment; only the decoding runs in the pool
+        sources = [open_band(path) for path in file_paths]
+        for path, src in zip(file_paths, sources):
+            # rasterio would silently resample into a differently shaped out array
+            if src.shape != sources[0].shape:
+                raise ValueError(f"{path} is {src.shape}, expected {sources[0].shape} like {file_paths[0]}")
+        dtype = np.result_type(*(src.dtypes[0] for src in sources))
+        image = np.empty((len(file_paths),) + sources[0].shape, dtype=dtype)
+
+        if band_threads > 1:
+            with ThreadPoolExecutor(max_workers=band_threads) as pool:
+                for future in [pool.submit(read_band, i) for i in range(len(file_paths))]:
+                    future.result() # Re-raise any read error
+        else:
+            for i in range(len(file_paths)):
+                read_band(i)
+
+    return image
+
+class BandStats:
+    """
+    Streaming, mergeable per-band statistics: count, mean, variance, min, max and a histogram.
+
+    Mean and variance are accumulated with Welford's algorithm in the pairwise form of Chan et al.,
+    so statistics of disjoint sets of scenes (e.g. from different worker processes) merge exactly.
+    The histogram counts float16 bit patterns, which needs no value range up front and is therefore
+    mergeable too; it is rebinned to equal-width bins between the final min and max in to_dict.
+
+    Args:
+        num_bands (int): Number of bands (channels) of the images.
+    """
+    def __init__(self, num_bands):
+        self.count = np.zeros(num_bands, dtype=np.int64)
+        self.mean = np.zeros(num_bands, dtype=np.float64)
+        self.m2 = np.zeros(num_bands, dtype=np.float64) # Sum of squared deviations from the mean
+        self.min = np.full(num_bands, np.inf)
+        self.max = np.full(num_bands, -np.inf)
+        self.hist = np.zeros((num_bands, 1 << 16), dtype=np.int64) # Indexed by float16 bit pattern
+
+    def _combine(self, count, mean, m2):
+        # Chan et al. pairwise update of (count, mean, M2)
+        total = self.count + count
+        delta = mean - self.mean
+        safe_total = np.maximum(total, 1)
+        self.mean = self.mean + delta * count / safe_total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / safe_total
+        self.count = total
+
+    def update(self, image):
+        """
+        Adds the pixels of one image. Non-finite values are ignored.
+
+        Args:
+            image (np.ndarray): Image with shape (C, H, W).
+        """
+        count = np.zeros_like(self.count)
+        mean = np.zeros_like(self.mean)
+        m2 = np.zeros_like(self.m2)
+        for b, band in enumerate(image):
+            x = band[np.isfinite(band)].astype(np.float64)
+            if x.size == 0:
+                continue
+            count[b] = x.size
+            mean[b] = x.mean()
+            m2[b] = np.sum((x - mean[b]) ** 2)
+            self.min[b] = min(self.min[b], x.min())
+            self.max[b] = max(self.max[b], x.max())
+            codes = np.clip(x, -65504, 65504).astype(np.float16).view(np.uint16)
+            self.hist[b] += np.bincount(codes, minlength=1 << 16)
+        self._combine(count, mean, m2)
+
+    def merge(self, other):
+        """
+        Adds the statistics of another BandStats over a disjoint set of images.
+
+        Args:
+            other (BandStats): Statistics to merge into this one.
+        """
+        self._combine(other.count, other.mean, other.m2)
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.hist += other.hist
+
+    def __getstate__(self):
+        # Send only the non-empty histogram bins between processes, a scene touches few float16 codes
+        state = self.__dict__.copy()
+        band, code = np.nonzero(self.hist)
+        state['hist'] = (self.hist.shape, band, code, self.hist[band, code])
+        return state
+
+    def __setstate__(self, state):
+        shape, band, code, counts = state['hist']
+        state['hist'] = np.zeros(shape, dtype=np.int64)
+        state['hist'][band, code] = counts
+        self.__dict__.update(state)
+
+    def save(self, path):
+        """
+        Writes the statistics to an .npz file, with only the non-empty histogram bins, replacing it atomically.
+
+        Args:
+            path (str): Path of the .npz file.
+        """
+        band, code = np.nonzero(self.hist)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, count=self.count, mean=self.mean, m2=self.m2, min=self.min, max=self.max,
+                     hist_band=band, hist_code=code, hist_counts=self.hist[band, code])
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads statistics written by save.
+
+        Args:
+            path (str): Path of the .npz file.
+
+        Returns:
+            BandStats: The saved statistics.
+        """
+        with np.load(path) as saved:
+            stats = cls(len(saved['count']))
+            stats.count, stats.mean, stats.m2 = saved['count'], saved['mean'], saved['m2']
+            stats.min, stats.max = saved['min'], saved['max']
+            stats.hist[saved['hist_band'], saved['hist_code']] = saved['hist_counts']
+        return stats
+
+    def to_dict(self, band_names, bins=256):
+        """
+        Finalises the statistics into a JSON-serialisable dict.
+
+        Args:
+            band_names (list): Name of each band, e.g. its source file name.
+            bins (int): Number of equal-width histogram bins between each band's min and max.
+
+        Returns:
+            dict: Per-band lists "count", "mean", "var", "std", "min", "max", "hist_edges" and "hist_counts".
+        """
+        var = self.m2 / np.maximum(self.count - 1, 1) # Unbiased sample variance
+        values = np.arange(1 << 16, dtype=np.uint16).view(np.float16).astype(np.float64)
+        finite = np.isfinite(values)
+        edges, counts = [], []
+        for b in range(len(band_names)):
+            used = finite & (self.hist[b] > 0)
+            if used.any():
+                # float16 rounding can land just outside [min, max], widen the range so no count is dropped
+                hist_range = (min(self.min[b], values[used].min()), max(self.max[b], values[used].max()))
+            else:
+                hist_range = (0.0, 1.0)
+            band_counts, band_edges = np.histogram(values[used], bins=bins, range=hist_range,
+                                                   weights=self.hist[b][used])
+            edges.append(band_edges.tolist())
+            counts.append(band_counts.astype(np.int64).tolist())
+        return {
+            "bands": list(band_names),
+            "count": self.count.tolist(),
+            "mean": self.mean.tolist(),
+            "var": var.tolist(),
+            "std": np.sqrt(var).tolist(),
+            "min": self.min.tolist(),
+            "max": self.max.tolist(),
+            "hist_edges": edges,
+            "hist_counts": counts,
+        }
+
+def plume_components(label):
+    """
+    Finds the distinct plumes of a binary label, with the same connectivity as evaluate_plume_metrics.
+
+    Args:
+        label (np.ndarray): Binary label with shape (H, W).
+
+    Returns:
+        dict: "shape" of the label, per-component "areas" and "bboxes" ([y0, x0, y1, x1], end-exclusive),
+            and "pixels", the flat (row-major) indices of all plume pixels grouped by component.
+    """
+    labeled_plumes, num_plumes = ndimage.label(label == 1)
+    flat = labeled_plumes.ravel()
+    plume_pixels = np.flatnonzero(flat)
+    return {
+        "shape": label.shape,
+        "areas": np.bincount(flat[plume_pixels], minlength=num_plumes + 1)[1:],
+        "bboxes": np.array([[s[0].start, s[1].start, s[0].stop, s[1].stop]
+                            for s in ndimage.find_objects(labeled_plumes)], dtype=np.int64).reshape(-1, 4),
+        "pixels": plume_pixels[np.argsort(flat[plume_pixels], kind='stable')],
+    }
+
+def mag1c_hotspots(mag1c, quantile=MAG1C_HOTSPOT_QUANTILE):
+    """
+    Finds the hotspots of a mag1c methane enhancement map, i.e. its pixels at or above the given quantile.
+
+    Args:
+        mag1c (np.ndarray): mag1c band with shape (H, W).
+        quantile (float): Per-scene quantile above which a pixel is a hotspot. Pixels that are not finite
+            or not positive never are, so scenes without any enhancement have no hotspots.
+
+    Returns:
+        np.ndarray: Sorted flat (row-major) indices of the hotspot pixels.
+    """
+    flat = np.asarray(mag1c, dtype=np.float32).ravel()
+    valid = np.isfinite(flat) & (flat > 0)
+    if not valid.any():
+        return np.zeros(0, dtype=np.int64)
+    threshold = np.quantile(flat[valid], quantile)
+    return np.flatnonzero(valid & (flat >= threshold)).astype(np.int64)
+
+def scene_plumes(label, image, band_files=BAND_FILES):
+    """
+    Indexes one scene: the plume_components of its label plus the mag1c_hotspots of its image.
+
+    Args:
+        label (np.ndarray): Binary label with shape (H, W).
+        image (np.ndarray): Image with shape (C, H, W), channels in band_files order.
+        band_files (list): Band file name of every channel; without mag1c the scene has no hotspots.
+
+    Returns:
+        dict: plume_components of the label with the hotspots under "hotspots".
+    """
+    plumes = plume_components(label)
+    if MAG1C_FILE in band_files:
+        plumes["hotspots"] = mag1c_hotspots(image[list(band_files).index(MAG1C_FILE)])
+    else:
+        plumes["hotspots"] = np.zeros(0, dtype=np.int64)
+    return plumes
+
+def save_plumes(path, plumes):
+    """
+    Writes a scene_plumes dict to an .npz file, replacing it atomically.
+
+    Args:
+        path (str): Path of the .npz file.
+        plumes (dict): Output of scene_plumes.
+    """
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, shape=np.array(plumes["shape"], dtype=np.int64), areas=plumes["areas"],
+                 bboxes=plumes["bboxes"], pixels=plumes["pixels"], hotspots=plumes["hotspots"])
+    os.replace(path + '.tmp', path)
+
+def load_plumes(path):
+    """
+    Reads a scene_plumes dict written by save_plumes.
+
+    Args:
+        path (str): Path of the .npz file.
+
+    Returns:
+        dict: The saved scene_plumes.
+    """
+    with np.load(path) as saved:
+        plumes = {key: saved[key] for key in saved.files}
+    plumes["shape"] = tuple(int(n) for n in plumes["shape"])
+    return plumes
+
+def write_plume_index(output_dir, image_ids, difficulty, plumes):
+    """
+    Writes the plume index of an output directory as one .npz file.
+
+    Per scene it holds "ids", "difficulty", "height", "width", "plume_pixels" and "num_plumes"; scene i
+    owns components component_offsets[i]:component_offsets[i + 1] of "areas" and "bboxes", and component
+    j owns pixels pixel_offsets[j]:pixel_offsets[j + 1] of "pixels". The mag1c hotspots of scene i are
+    hotspots[hotspot_offsets[i]:hotspot_offsets[i + 1]].
+
+    Args:
+        output_dir (str): Directory where preprocessed data is saved.
+        image_ids (list): Scene IDs, in CSV order.
+        difficulty (list): The CSV's difficulty value of each scene.
+        plumes (list): plume_components of each scene, with its mag1c_hotspots under "hotspots".
+    """
+    num_plumes = np.array([len(p["areas"]) for p in plumes], dtype=np.int64)
+    num_hotspots = np.array([len(p["hotspots"]) for p in plumes], dtype=np.int64)
+    areas = np.concatenate([p["areas"] for p in plumes] + [np.zeros(0, dtype=np.int64)])
+    np.savez(
+        os.path.join(output_dir, PLUME_INDEX_FILE),
+        ids=np.array(image_ids, dtype=str),
+        difficulty=np.array(difficulty, dtype=str),
+        height=np.array([p["shape"][0] for p in plumes], dtype=np.int64),
+        width=np.array([p["shape"][1] for p in plumes], dtype=np.int64),
+        plume_pixels=np.array([len(p["pixels"]) for p in plumes], dtype=np.int64),
+        num_plumes=num_plumes,
+        component_offsets=np.concatenate([[0], np.cumsum(num_plumes)]),
+        areas=areas,
+        bboxes=np.concatenate([p["bboxes"] for p in plumes] + [np.zeros((0, 4), dtype=np.int64)]),
+        pixel_offsets=np.concatenate([[0], np.cumsum(areas)]),
+        pixels=np.concatenate([p["pixels"] for p in plumes] + [np.zeros(0, dtype=np.int64)]),
+        hotspot_offsets=np.concatenate([[0], np.cumsum(num_hotspots)]),
+        hotspots=np.concatenate([p["hotspots"] for p in plumes] + [np.zeros(0, dtype=np.int64)]),
+    )
+
+def source_fingerprint(folder_path, band_files=BAND_FILES, hash_sources=False):
+    """
+    Fingerprints the source files of a scene so that changed scenes can be detected on rerun.
+
+    Args:
+        folder_path (str): Path to the scene folder.
+        band_files (list): Band file names that are preprocessed; the label file is always included.
+        hash_sources (bool): Use SHA-1 content hashes instead of (size, mtime). Slower, but robust
+            to copies that do not preserve modification times.
+
+    Returns:
+        dict: File name -> [size, mtime_ns], or file name -> SHA-1 hex digest.
+    """
+    fingerprint = {}
+    for file_name in list(band_files) + [LABEL_FILE]:
+        file_path = os.path.join(folder_path, file_name)
+        if hash_sources:
+            sha1 = hashlib.sha1()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(block)
+            fingerprint[file_name] = sha1.hexdigest()
+        else:
+            st = os.stat(file_path)
+            fingerprint[file_name] = [st.st_size, st.st_mtime_ns]
+    return fingerprint
+
+def load_manifest(output_dir):
+    """
+    Loads the preprocessing manifest of an output directory.
+
+    The manifest is a JSON-lines file with one entry per converted scene; a later line for the same
+    scene supersedes an earlier one. A truncated last line left by an interrupted run is ignored.
+
+    Args:
+        output_dir (str): Directory where preprocessed data is saved.
+
+    Returns:
+        dict: Scene ID -> manifest entry (empty if there is no manifest yet).
+    """
+    manifest = {}
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return manifest
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            manifest[entry['id']] = entry
+    return manifest
+
+def write_manifest(output_dir, manifest):
+    """
+    Rewrites the manifest with exactly one line per scene, replacing the file atomically.
+
+    Args:
+        output_dir (str): Directory where preprocessed data is saved.
+        manifest (dict): Scene ID -> manifest entry.
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    with open(manifest_path + '.tmp', 'w') as f:
+        for entry in manifest.values():
+            f.write(json.dumps(entry) + '\n')
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def is_up_to_date(entry, sources, output_dir, band_files=BAND_FILES, compact=False, stats=False):
+    """
+    Checks whether a scene's outputs are complete and were produced from the current source files.
+
+    Args:
+        entry (dict or None): The scene's manifest entry from a previous run.
+        sources (dict): The current source_fingerprint of the scene.
+        output_dir (str): Directory where preprocessed data is saved.
+        band_files (list): Band set (and channel order) the outputs are expected to have.
+        compact (bool): Whether the outputs are expected in the compact format.
+        stats (bool): Whether the scene's band statistics ({id}_stats.npz, see process_scene) are needed too.
+
+    Returns:
+        bool: True if the scene can be skipped.
+    """
+    if entry is None or not entry.get('complete') or entry['sources'] != sources:
+        return False
+    if entry.get('bands', BAND_FILES) != list(band_files) or entry.get('compact', False) != compact:
+        return False
+    image_id = entry['id']
+    if stats and not (entry.get('stats') and os.path.exists(os.path.join(output_dir, f"{image_id}_stats.npz"))):
+        return False
+    return (os.path.exists(os.path.join(output_dir, f"{image_id}_image.npy")) and
+            os.path.exists(os.path.join(output_dir, f"{image_id}_label.npy")))
+
+def compact_errors(image, image_f16):
+    """
+    Measures the per-band error of storing an image as float16 instead of its source dtype.
+
+    Args:
+        image (np.ndarray): Source image with shape (C, H, W).
+        image_f16 (np.ndarray): The same image cast to float16.
+
+    Returns:
+        dict: Per-band lists "max_abs", "max_rel" and "rmse" of the error, and "overflow", the number of
+            finite source values that became infinite (float16 saturates at 65504).
+    """
+    errors = {"max_abs": [], "max_rel": [], "rmse": [], "overflow": []}
+    for band, band_f16 in zip(image, image_f16):
+        band = band.astype(np.float64)
+        finite = np.isfinite(band)
+        overflow = finite & ~np.isfinite(band_f16)
+        valid = finite & ~overflow
+        diff = np.abs(band_f16.astype(np.float64)[valid] - band[valid])
+        magnitude = np.abs(band[valid])
+        nonzero = magnitude > 0
+        errors["max_abs"].append(float(diff.max()) if diff.size else 0.0)
+        errors["max_rel"].append(float((diff[nonzero] / magnitude[nonzero]).max()) if nonzero.any() else 0.0)
+        errors["rmse"].append(float(np.sqrt(np.mean(diff ** 2))) if diff.size else 0.0)
+        errors["overflow"].append(int(overflow.sum()))
+    return errors
+
+def process_scene(image_id, root_dir, output_dir, band_files=BAND_FILES, band_threads=1, compact=False,
+                  sources=None, stats=None, timer=None):
+    """
+    Converts a single scene folder into {id}_image.npy and {id}_label.npy.
+
+    The scene's plumes and mag1c hotspots are saved to {id}_plumes.npz (see scene_plumes) and, with stats,
+    its band statistics to {id}_stats.npz (see BandStats.save), so that reruns that skip the scene can index
+    and merge them without reading its outputs again. In the compact format the image is stored as float16 and the binary label is bit-packed along
+    its width with np.packbits, i.e. (H, ceil(W / 8)) uint8. The datasets decode both on load.
+
+    Args:
+        image_id (str): Scene ID, i.e. the name of the scene folder under root_dir.
+        root_dir (str): Root directory where image folders are located.
+        output_dir (str): Directory where preprocessed data will be saved.
+        band_files (list): Band file names to stack, in channel order.
+        band_threads (int): Number of threads used to read the bands of the scene concurrently.
+        compact (bool): Store float16 bands and bit-packed labels.
+        sources (dict, optional): source_fingerprint of the scene, recorded in the returned entry.
+        stats (BandStats, optional): Statistics updated with the scene's full-precision bands, which are saved too.
+        timer (StageTimer, optional): Records the time of each stage and the bytes read and written.
+
+    Returns:
+        dict: Manifest entry describing the scene's sources and outputs.
+    """
+    timer = timer or StageTimer()
+    folder_path = os.path.join(root_dir, image_id) # Construct the path to the image folder
+
+    with timer.stage("read"):
+        image = read_bands(folder_path, band_files, band_threads, timer) # Read the bands into a multi-band image
+
+        # Process the label file
+        label_file = os.path.join(folder_path, LABEL_FILE)  # Construct the path to the label file
+        with timer.stage("open"):
+            src = rasterio.open(label_file)
+        with src, timer.stage("decode"):
+            label = src.read(1)  # Read the label from the file
+        timer.add_read(label_file)
+
+    entry = {
+        "id": image_id,
+        "sources": sources,
+        "bands": list(band_files),
+        "compact": compact,
+        "image": {"shape": list(image.shape), "dtype": str(image.dtype)},
+        "label": {"shape": list(label.shape), "dtype": str(label.dtype)},
+    }
+
+    if stats is not None:
+        with timer.stage("stats"):
+            scene_stats = BandStats(len(band_files))
+            scene_stats.update(image)
+            scene_stats.save(os.path.join(output_dir, f"{image_id}_stats.npz"))
+            stats.merge(scene_stats)
+        entry["stats"] = True
+
+    if compact:
+        if label.size and label.max() > 1:
+            raise ValueError(f"{label_file} is not binary, it cannot be bit-packed")
+        with timer.stage("encode"):
+            image_out = image.astype(np.float16)
+            label_out = np.packbits(label.astype(bool), axis=-1)
+            entry["image"]["dtype"] = "float16"
+            entry["label"]["dtype"] = "uint8"
+            entry["compact_error"] = compact_errors(image, image_out)
+    else:
+        image_out, label_out = image, label
+
+    image_path = os.path.join(output_dir, f"{image_id}_image.npy")
+    label_path = os.path.join(output_dir, f"{image_id}_label.npy")
+    with timer.stage("save"):
+        np.save(image_path, image_out) # Save the image as a NumPy array
+        np.save(label_path, label_out)  # Save the label as a NumPy array
+    timer.add_written(image_path)
+    timer.add_written(label_path)
+
+    with timer.stage("plumes"):
+        # From the full-precision image, also in the compact format
+        save_plumes(os.path.join(output_dir, f"{image_id}_plumes.npz"), scene_plumes(label, image, band_files))
+
+    entry["complete"] = True # Only recorded once both outputs are on disk
+    return entry
+
+def _process_scene_safe(args):
+    """
+    Converts one scene unless it is up to date, capturing any exception so one broken scene does not abort the whole run.
+
+    Args:
+        args (tuple): (image_id, previous_entry, options), packed into one tuple so it can be used with
+            executor.map. options holds root_dir, output_dir, band_files, band_threads, hash_sources,
+            compact and compute_stats.
+
+    Returns:
+        tuple: (image_id, status, result, stats, plumes, timer) where status is "converted", "skipped" or
+            "failed" and result is the new manifest entry, None, or a "Type: message" string respectively.
+            stats is the scene's BandStats (None if statistics are disabled) and plumes its plume_components
+            plus its mag1c_hotspots (empty if mag1c is not in the band set); both are None if the scene failed. timer is the scene's StageTimer.
+    """
+    image_id, previous_entry, options = args
+    root_dir, output_dir = options['root_dir'], options['output_dir']
+    band_files = options['band_files']
+    stats = BandStats(len(band_files)) if options['compute_stats'] else None
+    timer = StageTimer()
+    try:
+        with timer.stage("fingerprint"):
+            sources = source_fingerprint(os.path.join(root_dir, image_id), band_files, options['hash_sources'])
+            up_to_date = is_up_to_date(previous_entry, sources, output_dir, band_files, options['compact'],
+                                       stats is not None)
+        if up_to_date:
+            if stats is not None:
+                # Merge the statistics saved when the scene was converted, its image is not read again
+                with timer.stage("stats"):
+                    stats.merge(BandStats.load(os.path.join(output_dir, f"{image_id}_stats.npz")))
+            status, entry = "skipped", None
+        else:
+            entry = process_scene(image_id, root_dir, output_dir, band_files, options['band_threads'],
+                                  options['compact'], sources, stats, timer)
+            status = "converted"
+
+        plumes_path = os.path.join(output_dir, f"{image_id}_plumes.npz")
+        with timer.stage("plumes"):
+            if os.path.exists(plumes_path):
+                # Saved by process_scene when the scene was converted
+                plumes = load_plumes(plumes_path)
+            else:
+                # Outputs of a run that predates the saved plumes: index them once from the outputs
+                label = np.load(os.path.join(output_dir, f"{image_id}_label.npy"))
+                image = np.load(os.path.join(output_dir, f"{image_id}_image.npy"), mmap_mode='r')
+                if options['compact']:
+                    label = np.unpackbits(label, axis=-1, count=image.shape[-1])
+                plumes = scene_plumes(label, image, band_files)
+                save_plumes(plumes_path, plumes)
+    except Exception as e:
+        return image_id, "failed", f"{type(e).__name__}: {e}", None, None, timer
+    return image_id, status, entry, stats, plumes, timer
+
+def preprocess_data(csv_file, root_dir, output_dir, band_files=None, num_workers=0, chunksize=4, band_threads=1,
+                    hash_sources=False, force=False, compact=False, compute_stats=True, report_file=None):
     """
     Preprocesses image and label data from a CSV file.
 
+    Scenes are independent, so with num_workers > 0 they are converted in a process pool.
+    Every scene is written by the same process_scene function, so the parallel output is
+    byte-identical to the serial one.
+
+    Preprocessing is incremental: every converted scene is appended to a manifest in output_dir
+    as soon as both of its outputs are written, and scenes whose source files are unchanged since
+    their manifest entry are skipped. Rerunning after an interruption, or after appending scenes to
+    the CSV, therefore only converts the scenes that are missing or changed.
+
+    Per-band normalisation statistics of all scenes in the CSV are accumulated in the same pass and
+    written to band_stats.json in output_dir (see BandStats). Skipped scenes contribute the statistics
+    saved when they were converted, so the statistics always cover the whole CSV at full precision without
+    reading their images again; scenes converted without statistics are reconverted once. Likewise the plumes of every label
+    and the mag1c hotspots of every scene, saved per scene on conversion, are indexed into plume_index.npz
+    (see write_plume_index), so evaluation and patch sampling can reuse them instead of scanning the masks again.
+
     Args:
         csv_file (str): Path to the CSV file containing image information.
         root_dir (str): Root directory where image folders are located.
         output_dir (str): Directory where preprocessed data will be saved.
+        band_files (list, optional): Band file names to stack into each image, in channel order, e.g. only the
+            SWIR bands and mag1c. Defaults to BAND_FILES. Changing the band set reconverts every scene.
+        num_workers (int): Number of worker processes. 0 converts the scenes serially in this process.
+        chunksize (int): Number of scenes handed to a worker per task submission.
+        band_threads (int): Number of threads each scene uses to read its bands concurrently.
+        hash_sources (bool): Detect changed scenes by content hash instead of file size and mtime.
+        force (bool): Reconvert every scene, ignoring the manifest.
+        compact (bool): Store bands as float16 and labels bit-packed, see process_scene. The float16
+            error against the source data is printed per band at the end of the run.
+        compute_stats (bool): Accumulate and write the per-band statistics.
+        report_file (str, optional): Also write the per-stage timing report (see timing_report) to this
+            JSON file, e.g. to compare storage backends or worker counts. It is always printed.
+
+    Returns:
+        dict: Scene ID -> error message for every scene that failed to convert (empty if all succeeded).
     """
     df = pd.read_csv(csv_file)  # Read the CSV file into a Pandas DataFrame
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for idx, row in tqdm(df.iterrows()): #Iterate through each row in the DataFrame
-        image_id = row['id'] # Get the image ID from the current row
-        folder_path = os.path.join(root_dir, image_id) # Construct the path to the image folder
-
-        # List of band file names
-        band_files = [
-            "TOA_AVIRIS_460nm.tif",
-            "TOA_AVIRIS_550nm.tif",
-            "TOA_AVIRIS_640nm.tif",
-            "TOA_AVIRIS_2004nm.tif",
-            "TOA_AVIRIS_2109nm.tif",
-            "TOA_AVIRIS_2310nm.tif",
-            "TOA_AVIRIS_2350nm.tif",
-            "TOA_AVIRIS_2360nm.tif",
-            "mag1c.tif"
-        ]
-        bands = []
-        for file_name in band_files: # Iterate through each band file
-            file_path = os.path.join(folder_path, file_name)
-            with rasterio.open(file_path) as src:
-                band = src.read(1) # Read the first band of the image
-                bands.append(band) # Add the band to the list
-
-        # Stack bands along the first dimension
-        image = np.stack(bands, axis=0) # Stack the bands into a multi-band image
-        np.save(os.path.join(output_dir, f"{image_id}_image.npy"), image) # Save the image as a NumPy array
+    band_files = list(BAND_FILES if band_files is None else band_files)
+    manifest = {} if force else load_manifest(output_dir)
+    options = {"root_dir": root_dir, "output_dir": output_dir, "band_files": band_files, "band_threads": band_threads,
+               "hash_sources": hash_sources, "compact": compact, "compute_stats": compute_stats}
+    tasks = [(image_id, manifest.get(image_id), options) for image_id in df['id']]
+    failures = {}
+    skipped = 0
+    stats = BandStats(len(band_files))
+    plumes = {}
+    timers = []
+    start = time.perf_counter()
 
-        # Process the label file
-        label_file = os.path.join(folder_path, "labelbinary.tif")  # Construct the path to the label file
-        with rasterio.open(label_file) as src:
-            label = src.read(1)  # Read the label from the file
-        np.save(os.path.join(output_dir, f"{image_id}_label.npy"), label)  # Save the label as a NumPy array
+    if num_workers > 0:
+        executor = ProcessPoolExecutor(max_workers=num_workers)
+        results = executor.map(_process_scene_safe, tasks, chunksize=chunksize)
+    else:
+        executor = None
+        results = map(_process_scene_safe, tasks)
+
+    manifest_file = open(os.path.join(output_dir, MANIFEST_FILE), 'w' if force else 'a')
+    try:
+        # Results arrive scene by scene, so the progress bar advances per scene in both modes
+        for image_id, status, result, scene_stats, scene_plumes, timer in tqdm(results, total=len(tasks)):
+            timers.append(timer)
+            if scene_stats is not None:
+                stats.merge(scene_stats)
+            if scene_plumes is not None:
+                plumes[image_id] = scene_plumes
+            if status == "failed":
+                failures[image_id] = result
+                tqdm.write(f"Failed to preprocess {image_id}: {result}")
+            elif status == "skipped":
+                skipped += 1
+            else:
+                # Record the scene as complete right away so an interrupted run resumes after it
+                manifest[image_id] = result
+                manifest_file.write(json.dumps(result) + '\n')
+                manifest_file.flush()
+    finally:
+        manifest_file.close()
+        if executor is not None:
+            # map submitted every chunk up front; after an error or interrupt, drop the ones not started yet
+            # instead of converting the rest of the dataset before the exception surfaces
+            executor.shutdown(cancel_futures=True)
+
+    # Compact the append-only log down to one line per scene
+    write_manifest(output_dir, manifest)
+
+    if compute_stats:
+        with open(os.path.join(output_dir, STATS_FILE), 'w') as f:
+            json.dump(stats.to_dict(band_files), f)
+
+    indexed = df[df['id'].isin(plumes)]
+    difficulty = indexed['difficulty'] if 'difficulty' in indexed else [""] * len(indexed)
+    write_plume_index(output_dir, list(indexed['id']), list(difficulty), [plumes[i] for i in indexed['id']])
+
+    report = timing_report(timers, time.perf_counter() - start)
+    print(f"Converted {len(tasks) - skipped - len(failures)} scenes, skipped {skipped} up-to-date scenes")
+    print_timing_report(report)
+    if report_file is not None:
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+    if failures:
+        print(f"{len(failures)}/{len(tasks)} scenes failed to preprocess")
+    if compact:
+        compact_summary = compact_report(df['id'], output_dir, manifest)
+        if compact_summary is not None:
+            print(f"Compact outputs: {compact_summary.attrs['compact_mb']:.1f} MB vs "
+                  f"{compact_summary.attrs['float32_mb']:.1f} MB as float32 images + uint8 labels")
+            print(compact_summary)
+    return failures
+
+def compact_report(image_ids, output_dir, manifest):
+    """
+    Summarises the float16 error and the disk footprint of compact scenes.
+
+    Args:
+        image_ids (iterable): Scene IDs to include.
+        output_dir (str): Directory where preprocessed data is saved.
+        manifest (dict): Scene ID -> manifest entry, as returned by load_manifest.
+
+    Returns:
+        pd.DataFrame: One row per band with the worst-case absolute and relative error, the mean RMSE and
+            the number of overflowed values, with the on-disk sizes versus float32 in its attrs. None if
+            none of the scenes has a compact output yet, e.g. because they all failed.
+    """
+    entries = [manifest[i] for i in image_ids if i in manifest and manifest[i].get('compact')]
+    if not entries:
+        return None
+    errors = {key: np.array([e["compact_error"][key] for e in entries]) for key in ("max_abs", "max_rel", "rmse", "overflow")}
+    report = pd.DataFrame({
+        "band": entries[0].get("bands", BAND_FILES),
+        "max_abs": errors["max_abs"].max(axis=0),
+        "max_rel": errors["max_rel"].max(axis=0),
+        "mean_rmse": errors["rmse"].mean(axis=0),
+        "overflow": errors["overflow"].sum(axis=0),
+    })
+
+    # Compare what is on disk with what float32 images and uint8 labels would take
+    compact_bytes = sum(os.path.getsize(os.path.join(output_dir, f"{e['id']}_{kind}.npy"))
+                        for e in entries for kind in ("image", "label"))
+    float32_bytes = sum(4 * np.prod(e["image"]["shape"]) + np.prod(e["label"]["shape"]) for e in entries)
+    report.attrs["compact_mb"] = compact_bytes / 1e6
+    report.attrs["float32_mb"] = float32_bytes / 1e6
+    return report
+
+def build_store(csv_file, preprocessed_dir, store_dir, force=False):
+    """
+    Packs the per-scene .npy files of a CSV into one consolidated, memory-mappable store.
+
+    The store holds five files instead of two per scene:
+      - images.npy: every scene's (C, H, W) image flattened and concatenated into one 1-D array.
+      - labels.npy: every scene's (H, W) label flattened and concatenated into one 1-D array.
+      - index.csv: per scene, its ID, element offsets into both arrays, its shape and whether it is compact.
+      - bands.json: the band file name of every channel.
+      - sources.json: a hash of the scenes' manifest entries, to tell whether the store is up to date.
+    A dataset can then memory-map the two arrays once and slice each sample out zero-copy.
+    Compact scenes are copied as stored, i.e. float16 images and bit-packed labels.
+
+    The store is a full second copy of the data, so it is only rebuilt if a scene of the CSV was converted
+    (or its manifest entry changed) since it was built.
+
+    Args:
+        csv_file (str): Path to the CSV file containing image IDs in column "id".
+        preprocessed_dir (str): Directory where preprocess_data saved the per-scene .npy files.
+        store_dir (str): Directory where the store will be written.
+        force (bool): Rebuild the store even if it is up to date.
+    """
+    df = pd.read_csv(csv_file)
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    manifest = load_manifest(preprocessed_dir)
+
+    # Scenes not in the manifest cannot be checked, so a store that includes any is always rebuilt
+    entries = [manifest.get(image_id) for image_id in df['id']]
+    sources = {"ids": list(df['id']), "sha1": hashlib.sha1(json.dumps(entries, sort_keys=True).encode()).hexdigest()}
+    sources_path = os.path.join(store_dir, "sources.json")
+    store_files = ["images.npy", "labels.npy", "index.csv", "bands.json", "sources.json"]
+    if not force and None not in entries and all(os.path.exists(os.path.join(store_dir, f)) for f in store_files):
+        with open(sources_path) as f:
+            if json.load(f) == sources:
+                print(f"{store_dir} is up to date")
+                return
+
+    # Plan the layout from the manifest, falling back to the .npy headers for scenes it does not cover
+    shapes, image_dtypes, label_dtypes, compact, bands = [], [], [], [], set()
+    for image_id in df['id']:
+        entry = manifest.get(image_id)
+        if entry is None:
+            image = np.load(os.path.join(preprocessed_dir, f"{image_id}_image.npy"), mmap_mode='r')
+            label = np.load(os.path.join(preprocessed_dir, f"{image_id}_label.npy"), mmap_mode='r')
+            entry = {"image": {"shape": image.shape, "dtype": str(image.dtype)},
+                     "label": {"shape": label.shape, "dtype": str(label.dtype)},
+                     "compact": label.shape[-1] != image.shape[-1]}
+        shapes.append(tuple(entry["image"]["shape"]))
+        image_dtypes.append(entry["image"]["dtype"])
+        label_dtypes.append(entry["label"]["dtype"])
+        compact.append(entry.get("compact", False))
+        bands.add(tuple(entry.get("bands", BAND_FILES)))
+    if len(bands) > 1:
+        raise ValueError(f"{preprocessed_dir} mixes band sets, rerun preprocess_data with force=True")
+    if len(set(compact)) > 1:
+        raise ValueError(f"{preprocessed_dir} mixes compact and full scenes, rerun preprocess_data with force=True")
+
+    image_sizes = np.array([c * h * w for c, h, w in shapes], dtype=np.int64)
+    label_sizes = np.array([h * ((w + 7) // 8 if packed else w) for (_, h, w), packed in zip(shapes, compact)],
+                           dtype=np.int64)
+    index = pd.DataFrame({
+        "id": df['id'].values,
+        "image_offset": np.concatenate([[0], np.cumsum(image_sizes)[:-1]]),
+        "label_offset": np.concatenate([[0], np.cumsum(label_sizes)[:-1]]),
+        "channels": [c for c, _, _ in shapes],
+        "height": [h for _, h, _ in shapes],
+        "width": [w for _, _, w in shapes],
+        "compact": compact,
+    })
+
+    # Write to temporary names so a reader never sees a half-built store
+    images_tmp = os.path.join(store_dir, "images.tmp.npy")
+    labels_tmp = os.path.join(store_dir, "labels.tmp.npy")
+    images = np.lib.format.open_memmap(images_tmp, mode='w+', shape=(int(image_sizes.sum()),),
+                                       dtype=np.result_type(*image_dtypes))
+    labels = np.lib.format.open_memmap(labels_tmp, mode='w+', shape=(int(label_sizes.sum()),),
+                                       dtype=np.result_type(*label_dtypes))
+
+    for row in tqdm(index.itertuples(), total=len(index)):
+        image = np.load(os.path.join(preprocessed_dir, f"{row.id}_image.npy"), mmap_mode='r')
+        label = np.load(os.path.join(preprocessed_dir, f"{row.id}_label.npy"), mmap_mode='r')
+        images[row.image_offset:row.image_offset + image.size] = image.ravel()
+        labels[row.label_offset:row.label_offset + label.size] = label.ravel()
+
+    images.flush()
+    labels.flush()
+    del images, labels
+    os.replace(images_tmp, os.path.join(store_dir, "images.npy"))
+    os.replace(labels_tmp, os.path.join(store_dir, "labels.npy"))
+    index.to_csv(os.path.join(store_dir, "index.csv"), index=False)
+    with open(os.path.join(store_dir, "bands.json"), 'w') as f:
+        json.dump(list(bands.pop()) if bands else list(BAND_FILES), f)
+    # Written last, so an interrupted build is redone on the next call
+    with open(sources_path, 'w') as f:
+        json.dump(sources, f)
+
+build_stores = False # Also pack each directory into one store for STARCOPStoreDataset, a second copy of the data
 
 #Preprocessing Train
 train_csv = "/content/drive/MyDrive/ClimateChange/STARCOP_train_easy/train_easy.csv"
 root_dir  = "/content/drive/MyDrive/ClimateChange/STARCOP_train_easy"
 output_dir = "/content/drive/MyDrive/ClimateChange/preprocessed/STARCOP_train_easy"
-preprocess_data(train_csv, root_dir, output_dir)
+preprocess_data(train_csv, root_dir, output_dir, num_workers=os.cpu_count(), band_threads=len(BAND_FILES))
+if build_stores:
+    build_store(train_csv, output_dir, output_dir + "_store")
 
 #Preprocessing Test
 test_csv  = "/content/drive/MyDrive/ClimateChange/STARCOP_test/test.csv"
 root_dir_test   = "/content/drive/MyDrive/ClimateChange/STARCOP_test"
 output_dir_test = "/content/drive/MyDrive/ClimateChange/preprocessed/STARCOP_test"
-preprocess_data(test_csv, root_dir_test, output_dir_test)
+preprocess_data(test_csv, root_dir_test, output_dir_test, num_workers=os.cpu_count(), band_threads=len(BAND_FILES))
+if build_stores:
+    build_store(test_csv, output_dir_test, output_dir_test + "_store")
@@ -0,0 +1,81 @@
+"""Command-line entry point that trains a model notebook with main_train, in one process or one per rank.
+
+The model notebooks are Colab exports: they install packages, mount Google Drive and read /content paths at
+import time, so they cannot be started with torchrun themselves. This script executes only their definitions
+(see load_notebook in benchmarks/amp_training.py) and trains on preprocessed directories given on the command
+line. Under torchrun every rank joins the process group (NCCL with GPUs, gloo on CPU, see setup_distributed),
+takes its shard of the size-bucketed training batches and validates its shard of the test scenes.
+
+Usage:
+    torchrun --nproc_per_node=G train_distributed.py --model resunet --train-csv train.csv --train-dir preprocessed/train
+                                                     --test-csv test.csv --test-dir preprocessed/test [--epochs 10]
+                                                     [--batch-size 4] [--base-channels 128] [--depth 4] [--lr 1e-4]
+                                                     [--normalize] [--amp] [--checkpoint-dir checkpoints]
+"""
+import argparse
+import os
+import sys
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+from amp_training import MODELS, load_notebook
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--model', choices=list(MODELS), default="resunet")
+    parser.add_argument('--train-csv', required=True)
+    parser.add_argument('--train-dir', required=True, help="Preprocessed directory of the training scenes")
+    parser.add_argument('--test-csv', required=True)
+    parser.add_argument('--test-dir', required=True, help="Preprocessed directory of the test scenes")
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--base-channels', type=int, default=128)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--lr', type=float, default=1e-4)
+    parser.add_argument('--normalize', action='store_true', help="Standardise the bands with the training set statistics")
+    parser.add_argument('--amp', action='store_true', help="Mixed precision training")
+    parser.add_argument('--num-workers', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', help="torch.distributed backend, nccl with GPUs and gloo otherwise by default")
+    parser.add_argument('--checkpoint-dir', default="checkpoints")
+    args = parser.parse_args()
+
+    file_name, constructor = MODELS[args.model]
+    notebook = load_notebook(os.path.join(ROOT, file_name))
+    device = notebook.setup_distributed(args.backend)
+    torch.manual_seed(args.seed)
+    model = eval(constructor.format(base_channels=args.base_channels, depth=args.depth), vars(notebook)).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    normalize = notebook.NormalizeBands(os.path.join(args.train_dir, "band_stats.json")) if args.normalize else None
+
+    train_dataset = notebook.STARCOPDataset(csv_file=args.train_csv, preprocessed_dir=args.train_dir, keep_dtypes=True)
+    test_dataset = notebook.STARCOPDataset(csv_file=args.test_csv, preprocessed_dir=args.test_dir, keep_dtypes=True)
+    train_sampler = notebook.SizeBucketBatchSampler(notebook.load_scene_shapes(args.train_dir, train_dataset.ids),
+                                                    args.batch_size, shuffle=True, seed=args.seed)
+    test_sampler = notebook.SizeBucketBatchSampler(notebook.load_scene_shapes(args.test_dir, test_dataset.ids),
+                                                   args.batch_size, shuffle=False, pad=False)
+    pin_memory = device.type == 'cuda'
+    train_loader = DataLoader(train_dataset, batch_sampler=train_sampler, num_workers=args.num_workers,
+                              pin_memory=pin_memory, collate_fn=notebook.pad_collate)
+    test_loader = DataLoader(test_dataset, batch_sampler=test_sampler, num_workers=args.num_workers,
+                             pin_memory=pin_memory, collate_fn=notebook.pad_collate)
+    plume_index_file = os.path.join(args.test_dir, "plume_index.npz")
+    plume_index = notebook.PlumeIndex(plume_index_file) if os.path.exists(plume_index_file) else None
+
+    try:
+        notebook.main_train(args.train_csv, args.test_csv, train_loader=train_loader, test_loader=test_loader,
+                            optimizer=optimizer, model=model, num_epochs=args.epochs, batch_size=args.batch_size,
+                            device=device, plume_index=plume_index, amp=args.amp, transform=normalize,
+                            checkpoint_dir=args.checkpoint_dir)
+    finally:
+        if dist.is_initialized():
+            dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    main()
@@ -22,13 +22,23 @@ import pandas as pd                                 #for data manipulation
 from torch.optim.lr_scheduler import ReduceLROnPlateau #for learning rate scheduling
 import os                                          #for file system operations
 import torch.optim as optim
+import torch.distributed as dist                  #for sharding data across processes
 
-from torch.utils.data import Dataset, DataLoader   #for data loading
+from torch.utils.data import Dataset, DataLoader, Sampler   #for data loading
+from torch.utils.data.distributed import DistributedSampler   #for sharding samples across processes
 import matplotlib.pyplot as plt                    #For plotting
 from tqdm import tqdm                              #For creating progress bars during loops
 import shutil                                      #for file operations
 import math                                        #for mathematical functions
 from scipy import ndimage                          #for multidimensional image processing
+import json                                        #for reading preprocessing outputs
+import multiprocessing as mp                       #for state shared between DataLoader workers
+from multiprocessing import shared_memory, resource_tracker #for the shared-memory sample cache
+import atexit                                      #for releasing shared memory on exit
+import secrets                                     #for unique shared-memory names
+import contextlib                                  #for optional context managers
+import threading                                   #for prefetching batches in the background
+import queue                                       #for handing prefetched batches over
 
 import torch
 import torch.nn as nn
@@ -96,37 +106,1095 @@ class UNet(nn.Module):
         out = self.conv_last(x)          # (B, n_class, H, W)
         return out
 
+def resolve_channels(bands, band_names):
+    """
+    Maps a band selection to channel indices.
+
+    Args:
+        bands (list): Band file names (e.g. "mag1c.tif") and/or channel indices.
+        band_names (list or None): Band file name of every stored channel; only needed if bands has names.
+
+    Returns:
+        list: Channel indices, in the order given.
+    """
+    return [band_names.index(band) if isinstance(band, str) else int(band) for band in bands]
+
+def load_band_names(preprocessed_dir):
+    """
+    Reads the band file name of every channel from the band_stats.json written by preprocess_data.
+
+    It is written once at the end of every run, with the bands of that run, whereas the manifest keeps
+    the entries of earlier runs and of scenes that were not converted. It needs the run to have computed
+    the statistics (compute_stats=True, the default), which NormalizeBands needs as well.
+
+    Args:
+        preprocessed_dir (str): Directory where preprocessed .npy files are stored.
+
+    Returns:
+        list: Band file names, in channel order.
+    """
+    with open(os.path.join(preprocessed_dir, "band_stats.json")) as f:
+        return json.load(f)['bands']
+
+class SharedSampleCache:
+    """
+    LRU cache of decoded samples in shared memory, visible to every DataLoader worker.
+
+    Each cached sample lives in its own shared-memory segment; which samples are cached, their shapes,
+    dtypes and last use are kept in shared arrays guarded by one lock. The cache must be created in the
+    main process before the DataLoader starts its workers. Once the epochs have filled it, workers copy
+    samples out of RAM instead of re-reading the .npy files.
+
+    Args:
+        num_samples (int): Number of samples in the dataset; samples are keyed by index.
+        max_bytes (int): Budget for the cached arrays. Least recently used samples are evicted to stay
+            under it. It is capped at the free space of /dev/shm less HEADROOM, and every put checks the
+            free space again, since overfilling tmpfs does not fail the allocation but kills the writer
+            with SIGBUS, and other caches and the DataLoader's batches take from the same space.
+    """
+    HEADROOM = 1024**3 # Bytes of /dev/shm left free for the DataLoader's own shared-memory batches
+    DTYPES = ['float32', 'float16', 'float64', 'uint8', 'int8', 'uint16', 'int16', 'int32', 'int64', 'bool']
+    EMPTY, FILLING, READY = 0, 1, 2
+
+    def __init__(self, num_samples, max_bytes):
+        if os.path.isdir('/dev/shm'):
+            free_bytes = max(shutil.disk_usage('/dev/shm').free - self.HEADROOM, 0)
+            if max_bytes > free_bytes:
+                print(f"Shared sample cache capped at {free_bytes / 1e9:.1f} GB, the free space of /dev/shm less headroom")
+                max_bytes = free_bytes
+        self.max_bytes = max_bytes
+        self.prefix = f"starcop_{secrets.token_hex(6)}"
+        self.lock = mp.Lock()
+        self.state = mp.RawArray('b', num_samples)
+        self.last_used = mp.RawArray('q', num_samples)
+        self.nbytes = mp.RawArray('q', num_samples)
+        self.shapes = mp.RawArray('q', num_samples * 5) # (C, H, W) of the image, (H, W) of the label
+        self.dtypes = mp.RawArray('b', num_samples * 2) # Indices into DTYPES of the image and label
+        self.counters = mp.RawArray('q', 4) # used bytes, clock, hits, misses
+        self.owner = os.getpid()
+        atexit.register(self.close)
+        # Workers must share this process's tracker, otherwise a worker's own tracker would unlink the
+        # segments it created as soon as the worker exits at the end of an epoch
+        resource_tracker.ensure_running()
+
+    def _name(self, idx):
+        return f"{self.prefix}_{idx}"
+
+    def get(self, idx):
+        """
+        Returns:
+            tuple or None: Copies of the cached (image, label) arrays, or None on a miss.
+        """
+        with self.lock:
+            if self.state[idx] != self.READY:
+                self.counters[3] += 1
+                return None
+            self.counters[1] += 1
+            self.counters[2] += 1
+            self.last_used[idx] = self.counters[1]
+            # Attach while holding the lock, an eviction after that only unlinks the name
+            shm = shared_memory.SharedMemory(name=self._name(idx))
+        try:
+            c, h, w, lh, lw = self.shapes[idx * 5:idx * 5 + 5]
+            image_dtype = np.dtype(self.DTYPES[self.dtypes[idx * 2]])
+            label_dtype = np.dtype(self.DTYPES[self.dtypes[idx * 2 + 1]])
+            image_bytes = c * h * w * image_dtype.itemsize
+            image = np.ndarray((c, h, w), dtype=image_dtype, buffer=shm.buf).copy()
+            label = np.ndarray((lh, lw), dtype=label_dtype, buffer=shm.buf, offset=image_bytes).copy()
+        finally:
+            shm.close()
+        return image, label
+
+    def put(self, idx, image, label):
+        """
+        Caches a sample, evicting least recently used samples if the budget requires it.
+
+        Args:
+            idx (int): Sample index.
+            image (np.ndarray): Image with shape (C, H, W).
+            label (np.ndarray): Label with shape (H, W).
+        """
+        nbytes = image.nbytes + label.nbytes
+        if nbytes > self.max_bytes or image.dtype.name not in self.DTYPES or label.dtype.name not in self.DTYPES:
+            return
+        with self.lock:
+            if self.state[idx] != self.EMPTY:
+                return # Cached, or being cached, by another worker
+            while self.counters[0] + nbytes > self.max_bytes:
+                ready = [i for i in range(len(self.state)) if self.state[i] == self.READY]
+                if not ready:
+                    return # The rest of the budget is still being filled
+                victim = min(ready, key=lambda i: self.last_used[i])
+                self._unlink(victim)
+                self.state[victim] = self.EMPTY
+                self.counters[0] -= self.nbytes[victim]
+            # Reserve the bytes, then copy outside the lock
+            self.state[idx] = self.FILLING
+            self.nbytes[idx] = nbytes
+            self.counters[0] += nbytes
+
+        try:
+            # tmpfs hands out segments larger than its free space and only fails when the pages are written
+            if os.path.isdir('/dev/shm') and shutil.disk_usage('/dev/shm').free < nbytes + self.HEADROOM:
+                raise OSError("not enough free space in /dev/shm")
+            shm = shared_memory.SharedMemory(name=self._name(idx), create=True, size=nbytes)
+        except OSError:
+            # /dev/shm is (nearly) full, give the reservation back
+            with self.lock:
+                self.state[idx] = self.EMPTY
+                self.counters[0] -= nbytes
+            return
+        try:
+            shm.buf[:image.nbytes] = np.ascontiguousarray(image).view(np.uint8).ravel()
+            shm.buf[image.nbytes:nbytes] = np.ascontiguousarray(label).view(np.uint8).ravel()
+        finally:
+            shm.close()
+
+        with self.lock:
+            self.shapes[idx * 5:idx * 5 + 5] = list(image.shape) + list(label.shape)
+            self.dtypes[idx * 2] = self.DTYPES.index(image.dtype.name)
+            self.dtypes[idx * 2 + 1] = self.DTYPES.index(label.dtype.name)
+            self.counters[1] += 1
+            self.last_used[idx] = self.counters[1]
+            self.state[idx] = self.READY
+
+    def _unlink(self, idx):
+        try:
+            shm = shared_memory.SharedMemory(name=self._name(idx))
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        """
+        Returns:
+            dict: Cached samples, used bytes, hits and misses so far.
+        """
+        with self.lock:
+            cached = sum(1 for state in self.state if state == self.READY)
+            return {"samples": cached, "bytes": self.counters[0], "hits": self.counters[2], "misses": self.counters[3]}
+
+    def close(self):
+        """Releases every segment. Only the process that created the cache does so."""
+        if os.getpid() != self.owner:
+            return
+        for idx in range(len(self.state)):
+            if self.state[idx] != self.EMPTY:
+                self._unlink(idx)
+                self.state[idx] = self.EMPTY
+        self.counters[0] = 0
+
+class LocalFileCache:
+    """
+    Read-through LRU cache of preprocessed .npy files on local disk, shared by every DataLoader worker.
+
+    Instead of copying whole preprocessed directories off Drive before training, a file is copied to local_dir
+    the first time it is read and served from there afterwards, so training starts right away and uses at most
+    max_bytes of local disk. Which files are local, their sizes and last use are kept in shared arrays guarded
+    by one lock, so the cache must be created in the main process before the DataLoader starts its workers.
+    A file that another worker is still copying, or that does not fit in the budget, is read from remote_dir.
+
+    Args:
+        remote_dir (str): Directory with the preprocessed files, e.g. on mounted Drive.
+        local_dir (str): Local directory the files are copied to. Files left in it by an earlier cache over
+            the same directory (e.g. a rerun of the notebook cell) are reused if their size and modification
+            time still match the remote file; stale copies and interrupted .part copies are deleted.
+        ids (list): Scene IDs whose {id}_image.npy and {id}_label.npy files are cached.
+        max_bytes (int): Budget for the local copies. Least recently used files are evicted to stay under
+            it. It is capped at the free space of local_dir.
+    """
+    EMPTY, FILLING, READY = 0, 1, 2
+
+    def __init__(self, remote_dir, local_dir, ids, max_bytes):
+        os.makedirs(local_dir, exist_ok=True)
+        self.remote_dir = remote_dir
+        self.local_dir = local_dir
+        # Sorted so workers look file names up with a binary search instead of a dict of Python strings
+        self.names = np.sort(np.array([f"{image_id}_{kind}.npy" for image_id in ids for kind in ("image", "label")]))
+        self.lock = mp.Lock()
+        self.state = mp.RawArray('b', len(self.names))
+        self.last_used = mp.RawArray('q', len(self.names))
+        self.nbytes = mp.RawArray('q', len(self.names))
+        self.counters = mp.RawArray('q', 4) # used bytes, clock, hits, misses
+
+        # Adopt complete copies from an earlier run that still match the remote file; copies carry over the
+        # remote modification time, and partial copies only ever exist under a .part name
+        with os.scandir(local_dir) as entries:
+            for entry in entries:
+                slot = self._slot(entry.name)
+                if slot is None:
+                    if entry.name.endswith(".part"):
+                        os.remove(entry.path)
+                    continue
+                local_stat = entry.stat()
+                try:
+                    remote_stat = os.stat(os.path.join(remote_dir, entry.name))
+                except FileNotFoundError:
+                    remote_stat = None
+                if remote_stat is None or (local_stat.st_size, local_stat.st_mtime_ns) != (remote_stat.st_size, remote_stat.st_mtime_ns):
+                    os.remove(entry.path) # Stale, the remote file was rewritten (e.g. preprocessed again) or removed
+                    continue
+                self.state[slot] = self.READY
+                self.nbytes[slot] = local_stat.st_size
+                self.counters[0] += self.nbytes[slot]
+        free_bytes = shutil.disk_usage(local_dir).free + self.counters[0]
+        if max_bytes > free_bytes:
+            print(f"Local file cache capped at {free_bytes / 1e9:.1f} GB, the free space of {local_dir}")
+            max_bytes = free_bytes
+        self.max_bytes = max_bytes
+
+    def _slot(self, name):
+        slot = np.searchsorted(self.names, name)
+        return int(slot) if slot < len(self.names) and self.names[slot] == name else None
+
+    def path(self, remote_path):
+        """
+        Returns the local copy of a file, copying it from remote_dir first if needed.
+
+        Args:
+            remote_path (str): Path of the file in remote_dir.
+
+        Returns:
+            str: Path to read the file from, the local copy or, if it cannot be made right now, remote_path.
+        """
+        name = os.path.basename(remote_path)
+        slot = self._slot(name)
+        if slot is None:
+            return remote_path
+        local_path = os.path.join(self.local_dir, name)
+        with self.lock:
+            if self.state[slot] == self.READY:
+                self.counters[1] += 1
+                self.counters[2] += 1
+                self.last_used[slot] = self.counters[1]
+                return local_path
+            self.counters[3] += 1
+            if self.state[slot] == self.FILLING:
+                return remote_path # Another worker, or the readahead thread, is copying it
+            self.state[slot] = self.FILLING
+        return local_path if self._copy(slot, remote_path, local_path) else remote_path
+
+    def _copy(self, slot, remote_path, local_path):
+        try:
+            remote_stat = os.stat(remote_path)
+            nbytes = remote_stat.st_size
+        except OSError:
+            nbytes = self.max_bytes + 1 # Let the read of the remote file raise the real error
+
+        with self.lock:
+            while nbytes <= self.max_bytes and self.counters[0] + nbytes > self.max_bytes:
+                ready = [i for i in range(len(self.state)) if self.state[i] == self.READY]
+                if not ready:
+                    break # The rest of the budget is still being copied
+                victim = min(ready, key=lambda i: self.last_used[i])
+                # Readers that already opened or mapped the file keep it until they close it
+                try:
+                    os.remove(os.path.join(self.local_dir, self.names[victim]))
+                except FileNotFoundError:
+                    pass
+                self.state[victim] = self.EMPTY
+                self.counters[0] -= self.nbytes[victim]
+            if nbytes > self.max_bytes or self.counters[0] + nbytes > self.max_bytes:
+                self.state[slot] = self.EMPTY
+                return False
+            # Reserve the bytes, then copy outside the lock
+            self.nbytes[slot] = nbytes
+            self.counters[0] += nbytes
+
+        part_path = f"{local_path}.{os.getpid()}.part"
+        try:
+            shutil.copyfile(remote_path, part_path)
+            # Keep the remote modification time so a later cache can tell whether the copy is still current
+            os.utime(part_path, ns=(remote_stat.st_atime_ns, remote_stat.st_mtime_ns))
+            os.replace(part_path, local_path) # Readers never see a partial copy under the final name
+        except OSError:
+            # Local disk full or the remote read failed, give the reservation back
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            with self.lock:
+                self.state[slot] = self.EMPTY
+                self.counters[0] -= nbytes
+            return False
+
+        with self.lock:
+            self.counters[1] += 1
+            self.last_used[slot] = self.counters[1]
+            self.state[slot] = self.READY
+        return True
+
+    def stats(self):
+        """
+        Returns:
+            dict: Local files, used bytes, hits and misses so far.
+        """
+        with self.lock:
+            cached = sum(1 for state in self.state if state == self.READY)
+            return {"files": cached, "bytes": self.counters[0], "hits": self.counters[2], "misses": self.counters[3]}
+
+class ReadaheadSampler(Sampler):
+    """
+    Wraps a sampler or batch sampler and copies the files of upcoming samples into a LocalFileCache in the background.
+
+    The order of a pass is drawn from the wrapped sampler up front, so shuffled orders are known in advance.
+    A thread then fetches the files of the samples in that order while staying at most readahead samples
+    ahead of the indices the DataLoader has taken, so it never evicts files that are about to be read.
+
+    Args:
+        sampler (Sampler): Yields dataset indices, or lists of indices like SizeBucketBatchSampler.
+        dataset (STARCOPDataset): Dataset created with a file_cache.
+        readahead (int): Number of samples fetched ahead of the DataLoader.
+    """
+    def __init__(self, sampler, dataset, readahead=64):
+        self.sampler = sampler
+        self.dataset = dataset
+        self.readahead = readahead
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        order = list(self.sampler)
+        indices = [idx for item in order for idx in (item if isinstance(item, (list, tuple)) else [item])]
+        ahead = threading.Semaphore(self.readahead)
+        stop = threading.Event()
+
+        def fetch():
+            for idx in indices:
+                ahead.acquire()
+                if stop.is_set():
+                    return
+                self.dataset.prefetch(idx)
+
+        # Not joined on exit: the thread finishes at most the copy it is in, which later readers reuse
+        threading.Thread(target=fetch, daemon=True).start()
+        try:
+            for item in order:
+                yield item
+                for _ in range(len(item) if isinstance(item, (list, tuple)) else 1):
+                    ahead.release()
+        finally:
+            stop.set()
+            ahead.release() # Wakes the thread if it is waiting, so it sees stop
+
+def batch_order(dataloader):
+    """
+    Returns the dataset indices in the order a DataLoader's batches visit them, to match samples to scene IDs.
+
+    A ReadaheadSampler is looked through to the sampler it wraps, so listing the order does not start a
+    readahead thread. The batch sampler must have a fixed order (shuffle=False).
+    """
+    batch_sampler = dataloader.batch_sampler
+    if isinstance(batch_sampler, ReadaheadSampler):
+        batch_sampler = batch_sampler.sampler
+    return np.array([i for batch in batch_sampler for i in batch], dtype=np.int64)
+
 class STARCOPDataset(Dataset):
-    def __init__(self, csv_file, preprocessed_dir, transform=None):
+    def __init__(self, csv_file, preprocessed_dir, transform=None, compact=False, bands=None, keep_dtypes=False,
+                 cache_bytes=0, file_cache=None):
         """
         Args:
             csv_file (str): Path to CSV file containing image IDs in column "id".
             preprocessed_dir (str): Directory where preprocessed .npy files are stored.
             transform (callable, optional): Optional transform to be applied on a sample.
+            compact (bool): The files were written with preprocess_data(compact=True), i.e. float16 images
+                and bit-packed labels, which are decoded here.
+            bands (list, optional): Band file names or channel indices to load, e.g. the SWIR bands and
+                mag1c. Images are then memory-mapped and only these channels are read. Defaults to all.
+            keep_dtypes (bool): Return the image in its stored dtype and the label as uint8 instead of
+                float32 / int64 copies. The .npy files are then memory-mapped and handed to torch without
+                copying; the training loops cast images to float on the device and the loss widens the labels.
+            cache_bytes (int): If > 0, keep up to this many bytes of decoded samples in a SharedSampleCache that
+                all DataLoader workers share, so later epochs are served from RAM.
+            file_cache (LocalFileCache, optional): Read the .npy files through this local-disk cache of
+                preprocessed_dir, e.g. when preprocessed_dir is on Drive. It can be shared by several datasets.
         """
-        self.df = pd.read_csv(csv_file)
+        # Only a flat NumPy array of IDs is kept and the paths are built per item, so neither __getitem__ nor the
+        # worker processes the dataset is copied into have to touch a DataFrame
+        self.ids = np.array(pd.read_csv(csv_file)['id'], dtype=str)
         self.preprocessed_dir = preprocessed_dir
         self.transform = transform
+        self.compact = compact
+        self.keep_dtypes = keep_dtypes
+        if bands is not None and any(isinstance(band, str) for band in bands):
+            self.channels = resolve_channels(bands, load_band_names(preprocessed_dir))
+        else:
+            self.channels = None if bands is None else resolve_channels(bands, None)
+        self.cache = SharedSampleCache(len(self.ids), cache_bytes) if cache_bytes > 0 else None
+        self.file_cache = file_cache
 
     def __len__(self):
-        return len(self.df)
+        return len(self.ids)
 
     def __getitem__(self, idx):
-        image_id = self.df.iloc[idx]['id']
+        cached = self.cache.get(idx) if self.cache is not None else None
+        if cached is not None:
+            image, label = cached
+        else:
+            image, label = self._load_arrays(idx)
+            if self.cache is not None:
+                self.cache.put(idx, image, label)
+
+        if self.keep_dtypes:
+            image_tensor = torch.from_numpy(image)
+            label_tensor = torch.from_numpy(label.astype(np.uint8, copy=False))
+        else:
+            image_tensor = torch.from_numpy(image).float()
+            label_tensor = torch.from_numpy(label).long()
+
+        if self.transform:
+            image_tensor, label_tensor = self.transform(image_tensor, label_tensor)
+
+        return image_tensor, label_tensor
+
+    def _paths(self, idx):
+        image_id = self.ids[idx]
         image_path = os.path.join(self.preprocessed_dir, f"{image_id}_image.npy")
         label_path = os.path.join(self.preprocessed_dir, f"{image_id}_label.npy")
+        if self.file_cache is not None:
+            image_path, label_path = self.file_cache.path(image_path), self.file_cache.path(label_path)
+        return image_path, label_path
+
+    def prefetch(self, idx):
+        """Copies the files of a sample into the file_cache ahead of its read, see ReadaheadSampler."""
+        if self.file_cache is not None:
+            self._paths(idx)
+
+    def _read(self, idx, read, *args):
+        # Calls read(image_path, label_path, *args) on the files of sample idx
+        try:
+            return read(*self._paths(idx), *args)
+        except FileNotFoundError:
+            if self.file_cache is None:
+                raise
+            # Another worker evicted a local copy between the lookup and the read; looking the files up
+            # again copies them back, or returns the remote paths
+            return read(*self._paths(idx), *args)
+
+    def _load_arrays(self, idx):
+        return self._read(idx, self._read_arrays)
+
+    def _read_arrays(self, image_path, label_path):
+        if self.channels is not None:
+            # Channels are contiguous in the (C, H, W) file, so only the selected ones are paged in
+            image = np.load(image_path, mmap_mode='r')[self.channels]
+        elif self.keep_dtypes:
+            # Copy-on-write maps are writable, so torch.from_numpy accepts them without copying
+            image = np.load(image_path, mmap_mode='c')
+        else:
+            image = np.load(image_path)
+        label = np.load(label_path, mmap_mode='c' if self.keep_dtypes else None)
+
+        if self.compact:
+            # Unpack the label bits back to one uint8 per pixel; the float16 image is widened by .float()
+            label = np.unpackbits(label, axis=-1, count=image.shape[-1])
+        return image, label
+
+class STARCOPStoreDataset(Dataset):
+    def __init__(self, csv_file, store_dir, transform=None, bands=None, keep_dtypes=False):
+        """
+        Dataset over a consolidated store written by build_store in the preprocessing notebook.
+
+        The store's images.npy and labels.npy are memory-mapped once per worker and every sample is
+        a zero-copy view into them, so a sample costs no file opens or .npy header parsing.
+
+        Args:
+            csv_file (str): Path to CSV file containing image IDs in column "id". May select a subset of the store.
+            store_dir (str): Directory containing images.npy, labels.npy, index.csv and bands.json.
+            transform (callable, optional): Optional transform to be applied on a sample.
+            bands (list, optional): Band file names or channel indices to load. Only these channels are read
+                from the memory map, so I/O and host memory scale with the channels used. Defaults to all.
+            keep_dtypes (bool): Return the image in its stored dtype and the label as uint8 instead of
+                float32 / int64 copies, as in STARCOPDataset.
+        """
+        df = pd.read_csv(csv_file)
+        index = pd.read_csv(os.path.join(store_dir, "index.csv")).set_index('id').loc[df['id']]
+        self.ids = np.array(df['id'], dtype=str)
+        self.store_dir = store_dir
+        self.transform = transform
+        self.keep_dtypes = keep_dtypes
+
+        # Plain arrays so __getitem__ does no pandas lookups
+        self.image_offsets = index['image_offset'].to_numpy()
+        self.label_offsets = index['label_offset'].to_numpy()
+        self.shapes = index[['channels', 'height', 'width']].to_numpy()
+        self.compact = index['compact'].to_numpy()
+        with open(os.path.join(store_dir, "bands.json")) as f:
+            self.band_names = json.load(f)
+        self.channels = None if bands is None else resolve_channels(bands, self.band_names)
+
+        # Memory maps are opened lazily so that each DataLoader worker maps the store itself
+        self.images = None
+        self.labels = None
+
+    def __getstate__(self):
+        # Never pickle the memory maps into worker processes, only the paths and index
+        state = self.__dict__.copy()
+        state['images'] = None
+        state['labels'] = None
+        return state
 
-        image = np.load(image_path)
-        label = np.load(label_path)
+    def __len__(self):
+        return len(self.image_offsets)
 
-        image_tensor = torch.from_numpy(image).float()
-        label_tensor = torch.from_numpy(label).long()
+    def __getitem__(self, idx):
+        if self.images is None:
+            # Copy-on-write maps are writable, so torch.from_numpy accepts them without copying
+            self.images = np.load(os.path.join(self.store_dir, "images.npy"), mmap_mode='c')
+            self.labels = np.load(os.path.join(self.store_dir, "labels.npy"), mmap_mode='c')
+
+        c, h, w = self.shapes[idx]
+        image_offset = self.image_offsets[idx]
+        label_offset = self.label_offsets[idx]
+        image = self.images[image_offset:image_offset + c * h * w].reshape(c, h, w)
+        if self.channels is not None:
+            image = image[self.channels] # Copies only the selected channels out of the map
+        if self.compact[idx]:
+            # Labels are bit-packed along the width; the float16 image is widened by .float()
+            packed_w = (w + 7) // 8
+            label = self.labels[label_offset:label_offset + h * packed_w].reshape(h, packed_w)
+            label = np.unpackbits(label, axis=-1, count=w)
+        else:
+            label = self.labels[label_offset:label_offset + h * w].reshape(h, w)
+
+        if self.keep_dtypes:
+            image_tensor = torch.from_numpy(image)
+            label_tensor = torch.from_numpy(label.astype(np.uint8, copy=False))
+        else:
+            image_tensor = torch.from_numpy(image).float()
+            label_tensor = torch.from_numpy(label).long()
 
         if self.transform:
             image_tensor, label_tensor = self.transform(image_tensor, label_tensor)
 
         return image_tensor, label_tensor
 
+class PlumeIndex:
+    """
+    Reader for the plume_index.npz written by preprocess_data.
+
+    Gives the precomputed connected components (plumes) of every label and mag1c hotspots of every scene,
+    so evaluation and patch sampling do not have to scan the masks, plus a per-scene summary table for
+    cheap dataset-statistics queries.
+
+    Args:
+        index_file (str): Path to plume_index.npz.
+    """
+    def __init__(self, index_file):
+        with np.load(index_file) as data:
+            self.data = {key: data[key] for key in data.files}
+        self.row = {image_id: i for i, image_id in enumerate(self.data['ids'])}
+
+    def summary(self):
+        """
+        Returns:
+            pd.DataFrame: One row per scene with id, difficulty, height, width, plume_pixels and num_plumes.
+        """
+        columns = ['ids', 'difficulty', 'height', 'width', 'plume_pixels', 'num_plumes']
+        return pd.DataFrame({key: self.data[key] for key in columns}).rename(columns={'ids': 'id'})
+
+    def components(self, image_id):
+        """
+        Args:
+            image_id (str): Scene ID.
+
+        Returns:
+            tuple: (areas, bboxes, pixels, starts) of the scene's plumes. pixels holds the flat indices of all
+                plume pixels grouped by component and component k starts at pixels[starts[k]].
+        """
+        i = self.row[image_id]
+        first, last = self.data['component_offsets'][i], self.data['component_offsets'][i + 1]
+        offsets = self.data['pixel_offsets'][first:last + 1]
+        pixels = self.data['pixels'][offsets[0]:offsets[-1]]
+        return self.data['areas'][first:last], self.data['bboxes'][first:last], pixels, offsets[:-1] - offsets[0]
+
+    def hotspots(self, image_id):
+        """
+        Args:
+            image_id (str): Scene ID.
+
+        Returns:
+            np.ndarray: Flat indices of the scene's mag1c hotspots, empty if mag1c was not preprocessed
+                or the index predates hotspots.
+        """
+        if 'hotspots' not in self.data:
+            return np.zeros(0, dtype=np.int64)
+        i = self.row[image_id]
+        return self.data['hotspots'][self.data['hotspot_offsets'][i]:self.data['hotspot_offsets'][i + 1]]
+
+class STARCOPPatchDataset(STARCOPDataset):
+    def __init__(self, csv_file, preprocessed_dir, patch_size=128, patches_per_epoch=None, plume_fraction=0.5,
+                 jitter=None, transform=None, compact=False, bands=None, keep_dtypes=False, file_cache=None):
+        """
+        Dataset of random fixed-size crops of the preprocessed scenes, biased towards plumes.
+
+        A plume_fraction of the crops are placed around a target pixel, which is either a labelled plume
+        pixel or a mag1c hotspot. Targets are taken from the plume index written by preprocess_data, so no
+        masks are scanned at load time. Every plume component and every scene's set of hotspots is drawn
+        equally often, so small plumes are not drowned out by large ones. The remaining crops are placed
+        uniformly at random in a random scene. Only the rows of the crop are read from the .npy files.
+
+        Crops are random per item and follow torch's RNG, which DataLoader seeds differently in every worker.
+
+        Args:
+            csv_file (str): Path to CSV file containing image IDs in column "id".
+            preprocessed_dir (str): Directory with the preprocessed .npy files and plume_index.npz.
+            patch_size (int): Side of the square crops. Must not exceed any scene's height or width.
+            patches_per_epoch (int, optional): Length of the dataset. Defaults to the number of crops that
+                tile all scenes, so an epoch sees about as many pixels as a full-scene epoch.
+            plume_fraction (float): Fraction of crops placed around a plume pixel or mag1c hotspot.
+            jitter (int, optional): Largest offset of the target pixel from the crop centre, so targets do not
+                always sit in the middle. Must be below patch_size // 2. Defaults to patch_size // 4.
+            transform (callable, optional): Optional transform to be applied on a sample.
+            compact (bool): The files were written with preprocess_data(compact=True).
+            bands (list, optional): Band file names or channel indices to load. Defaults to all.
+            keep_dtypes (bool): Return the image in its stored dtype and the label as uint8 instead of
+                float32 / int64 copies, as in STARCOPDataset.
+            file_cache (LocalFileCache, optional): Read the .npy files through this local-disk cache.
+        """
+        super().__init__(csv_file, preprocessed_dir, transform=transform, compact=compact, bands=bands,
+                         keep_dtypes=keep_dtypes, file_cache=file_cache)
+        self.patch_size = patch_size
+        self.plume_fraction = plume_fraction
+        self.jitter = patch_size // 4 if jitter is None else jitter
+        if not 0 <= self.jitter < patch_size // 2:
+            raise ValueError(f"jitter must be in [0, {patch_size // 2}), got {self.jitter}")
+
+        index = PlumeIndex(os.path.join(preprocessed_dir, "plume_index.npz"))
+        rows = [index.row[image_id] for image_id in self.ids]
+        self.heights = index.data['height'][rows]
+        self.widths = index.data['width'][rows]
+        too_small = (self.heights < patch_size) | (self.widths < patch_size)
+        if too_small.any():
+            raise ValueError(f"{too_small.sum()} scenes are smaller than patch_size={patch_size}, "
+                             f"e.g. {self.ids[np.argmax(too_small)]}")
+        self.patches_per_epoch = patches_per_epoch or int(np.ceil((self.heights * self.widths).sum() / patch_size ** 2))
+
+        # Each target owns target_pixels[target_starts[t]:target_stops[t]], flat pixel indices into scene target_scenes[t]
+        pixels, scenes, sizes = [], [], []
+        for i, image_id in enumerate(self.ids):
+            areas, _, plume_pixels, _ = index.components(image_id)
+            hotspots = index.hotspots(image_id)
+            pixels += [plume_pixels, hotspots]
+            scenes += [i] * (len(areas) + (len(hotspots) > 0))
+            sizes += list(areas) + ([len(hotspots)] if len(hotspots) else [])
+        self.target_pixels = np.concatenate(pixels + [np.zeros(0, dtype=np.int64)])
+        self.target_scenes = np.array(scenes, dtype=np.int64)
+        self.target_stops = np.cumsum(np.array(sizes, dtype=np.int64))
+        self.target_starts = self.target_stops - np.array(sizes, dtype=np.int64)
+
+    def __len__(self):
+        return self.patches_per_epoch
+
+    def __getitem__(self, idx):
+        size = self.patch_size
+        if len(self.target_scenes) and torch.rand(()).item() < self.plume_fraction:
+            target = torch.randint(len(self.target_scenes), ()).item()
+            scene = self.target_scenes[target]
+            pixel = self.target_pixels[torch.randint(self.target_starts[target], self.target_stops[target], ()).item()]
+            y, x = divmod(int(pixel), int(self.widths[scene]))
+            dy, dx = torch.randint(-self.jitter, self.jitter + 1, (2,)).tolist()
+            # Clamping to the scene keeps the target inside the crop, as the jitter is below half the crop
+            y0 = min(max(y + dy - size // 2, 0), self.heights[scene] - size)
+            x0 = min(max(x + dx - size // 2, 0), self.widths[scene] - size)
+        else:
+            scene = torch.randint(len(self.ids), ()).item()
+            y0 = torch.randint(self.heights[scene] - size + 1, ()).item()
+            x0 = torch.randint(self.widths[scene] - size + 1, ()).item()
+
+        image, label = self._load_patch(scene, int(y0), int(x0))
+        if self.keep_dtypes:
+            image_tensor = torch.from_numpy(image)
+            label_tensor = torch.from_numpy(label.astype(np.uint8, copy=False))
+        else:
+            image_tensor = torch.from_numpy(image).float()
+            label_tensor = torch.from_numpy(label).long()
+
+        if self.transform:
+            image_tensor, label_tensor = self.transform(image_tensor, label_tensor)
+
+        return image_tensor, label_tensor
+
+    def _load_patch(self, scene, y0, x0):
+        return self._read(scene, self._read_patch, scene, y0, x0)
+
+    def _read_patch(self, image_path, label_path, scene, y0, x0):
+        rows, cols = slice(y0, y0 + self.patch_size), slice(x0, x0 + self.patch_size)
+        image = np.load(image_path, mmap_mode='r')
+        channels = slice(None) if self.channels is None else self.channels
+        image = np.array(image[channels, rows, cols]) # Pages in only the crop's rows
+        label = np.load(label_path, mmap_mode='r')
+        if self.compact:
+            # Labels are bit-packed along the width, so unpack the crop's rows before cutting the columns
+            label = np.unpackbits(label[rows], axis=-1, count=int(self.widths[scene]))[:, cols]
+        else:
+            label = np.array(label[rows, cols])
+        return image, label
+
+class NormalizeBands:
+    """
+    Standardises every channel with the per-band statistics written by preprocess_data (band_stats.json).
+
+    Usable as the transform of STARCOPDataset / STARCOPStoreDataset, and directly on (B, C, H, W) batches, e.g. as
+    the transform of train_one_epoch and validate, which apply it on the device. Pixels padded by pad_samples
+    (labelled PAD_LABEL) stay 0, the band mean, as when the samples are normalised before padding.
+
+    Args:
+        stats_file (str): Path to band_stats.json, normally the one of the training set.
+        bands (list, optional): Band file names or channel indices loaded by the dataset. Defaults to all.
+        eps (float): Lower bound on the standard deviation, for constant bands.
+    """
+    def __init__(self, stats_file, bands=None, eps=1e-6):
+        with open(stats_file) as f:
+            stats = json.load(f)
+        channels = list(range(len(stats['bands']))) if bands is None else resolve_channels(bands, stats['bands'])
+        self.bands = [stats['bands'][c] for c in channels]
+        self.mean = torch.tensor(stats['mean'], dtype=torch.float32)[channels].view(-1, 1, 1)
+        self.std = torch.tensor(stats['std'], dtype=torch.float32)[channels].clamp(min=eps).view(-1, 1, 1)
+
+    def __call__(self, image, label):
+        image = (image - self.mean.to(image.device)) / self.std.to(image.device)
+        if label is not None and image.dim() == 4:
+            image = image.masked_fill((label == PAD_LABEL).unsqueeze(1), 0)
+        return image, label
+
+# Label of pixels that only exist because a sample was padded to the size of its batch; ignored by the losses and metrics
+PAD_LABEL = 255
+
+def pad_samples(images, labels, multiple=1):
+    """
+    Pads (C, H, W) images and (H, W) labels at the bottom and right to their largest height and width.
+
+    Args:
+        images (list): Image tensors of possibly different sizes.
+        labels (list): The matching label tensors.
+        multiple (int): Also round the padded height and width up to a multiple of this, e.g. 2**depth.
+
+    Returns:
+        tuple: (images, labels) lists with one common shape. Images are padded with 0, which is the band mean
+            after NormalizeBands, and labels with PAD_LABEL. Samples that already have the shape are not copied.
+    """
+    H = max(image.shape[-2] for image in images)
+    W = max(image.shape[-1] for image in images)
+    H, W = -(-H // multiple) * multiple, -(-W // multiple) * multiple
+    padded_images, padded_labels = [], []
+    for image, label in zip(images, labels):
+        pad = (0, W - image.shape[-1], 0, H - image.shape[-2])
+        if any(pad):
+            image, label = F.pad(image, pad), F.pad(label, pad, value=PAD_LABEL)
+        padded_images.append(image)
+        padded_labels.append(label)
+    return padded_images, padded_labels
+
+def pad_collate(batch, multiple=1):
+    """
+    Collates (image, label) samples of different sizes, padding them with pad_samples to the largest in the batch.
+
+    Use functools.partial(pad_collate, multiple=...) to round the padded size up as well.
+    """
+    images, labels = pad_samples(*zip(*batch), multiple=multiple)
+    return torch.stack(images), torch.stack(labels)
+
+def load_scene_shapes(preprocessed_dir, ids):
+    """
+    Reads the (H, W) of every scene from the manifest written by preprocess_data, without opening any .npy file.
+
+    Args:
+        preprocessed_dir (str): Directory where preprocessed .npy files are stored.
+        ids (list): Scene IDs, e.g. the dataset's ids.
+
+    Returns:
+        np.ndarray: (len(ids), 2) array of heights and widths.
+    """
+    shapes = {}
+    with open(os.path.join(preprocessed_dir, "manifest.jsonl")) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue # Truncated last line of an interrupted run
+            shapes[entry['id']] = entry['image']['shape'][-2:] # Later entries of a scene replace earlier ones
+    return np.array([shapes[image_id] for image_id in ids], dtype=np.int64).reshape(-1, 2)
+
+class BatchAugment:
+    """
+    Random flips, 90 degree rotations and spectral jitter applied to a whole batch at once.
+
+    Every sample draws one of the flips / rotations, but the batch is processed per drawn transform rather
+    than per sample: the samples sharing a transform are stacked, flipped and jittered with one tensor op
+    each and written into a contiguous slice of the output, which also replaces the default collate copy.
+    The batch therefore comes out grouped by transform, i.e. in a different sample order than it went in;
+    every label stays with its image and goes through the exact same transform. A transpose combined with
+    a vertical and a horizontal flip covers all 8 flips and rotations. Transposes are only drawn for square
+    samples, e.g. of STARCOPPatchDataset. Samples of different sizes are first padded with pad_samples.
+
+    Use it as the collate function of the training DataLoader, collate_fn=BatchAugment(...).collate, so it
+    runs in the workers, or call it directly on (B, C, H, W) images and (B, H, W) labels, e.g. on the device.
+
+    Args:
+        p_flip (float): Probability of each of the vertical and horizontal flips.
+        p_transpose (float): Probability of swapping H and W; with p_flip=0.5 and p_transpose=0.5 all 8
+            flips and rotations are equally likely.
+        spectral_gain (float): Standard deviation of a per-sample, per-band multiplicative gain around 1.
+        spectral_offset (float): Standard deviation of a per-sample, per-band additive offset.
+        pad_multiple (int): Round the padded height and width up to a multiple of this, see pad_samples.
+    """
+    def __init__(self, p_flip=0.5, p_transpose=0.5, spectral_gain=0.0, spectral_offset=0.0, pad_multiple=1):
+        self.p_flip = p_flip
+        self.p_transpose = p_transpose
+        self.spectral_gain = spectral_gain
+        self.spectral_offset = spectral_offset
+        self.pad_multiple = pad_multiple
+
+    def __call__(self, images, labels):
+        return self._augment(list(images), list(labels))
+
+    def collate(self, batch):
+        """Collates a list of (image, label) samples into an augmented (images, labels) batch."""
+        images, labels = zip(*batch)
+        return self._augment(images, labels)
+
+    def _augment(self, images, labels):
+        images, labels = pad_samples(images, labels, self.pad_multiple)
+        B = len(images)
+        C, H, W = images[0].shape
+        device = images[0].device
+
+        # Bit 0: horizontal flip, bit 1: vertical flip, bit 2: transpose
+        codes = (torch.rand(B, 3) < torch.tensor([self.p_flip, self.p_flip, self.p_transpose if H == W else 0.0]))
+        codes = (codes.long() * torch.tensor([1, 2, 4])).sum(1)
+        order = torch.argsort(codes, stable=True)
+        jitter = self.spectral_gain > 0 or self.spectral_offset > 0
+        if jitter:
+            gain = (1 + self.spectral_gain * torch.randn(B, C, 1, 1, device=device)).to(images[0].dtype)
+            offset = (self.spectral_offset * torch.randn(B, C, 1, 1, device=device)).to(images[0].dtype)
+
+        out_images = torch.empty((B, C, H, W), dtype=images[0].dtype, device=device)
+        out_labels = torch.empty((B, H, W), dtype=labels[0].dtype, device=device)
+        start = 0
+        for code, count in zip(*torch.unique_consecutive(codes[order], return_counts=True)):
+            code, end = int(code), start + int(count)
+            members = order[start:end].tolist()
+            x = torch.stack([images[i] for i in members])
+            y = torch.stack([labels[i] for i in members])
+            flips = [dim for dim, bit in ((-1, 1), (-2, 2)) if code & bit]
+            if flips:
+                x, y = x.flip(flips), y.flip(flips)
+            if code & 4:
+                x, y = x.transpose(-2, -1), y.transpose(-2, -1) # A view, materialised by the write below
+            if jitter:
+                torch.addcmul(offset[start:end], x, gain[start:end], out=out_images[start:end])
+            else:
+                out_images[start:end] = x
+            out_labels[start:end] = y
+            start = end
+
+        return out_images, out_labels
+
+def resolve_shard(num_replicas=None, rank=None):
+    """
+    Fills in the number of processes and this process's rank from torch.distributed if they are not given.
+
+    Returns:
+        tuple: (num_replicas, rank); (1, 0) when no process group is initialised.
+    """
+    distributed = dist.is_available() and dist.is_initialized()
+    if num_replicas is None:
+        num_replicas = dist.get_world_size() if distributed else 1
+    if rank is None:
+        rank = dist.get_rank() if distributed else 0
+    if not 0 <= rank < num_replicas:
+        raise ValueError(f"rank {rank} is not in [0, {num_replicas})")
+    return num_replicas, rank
+
+def shard(items, num_replicas, rank, drop_last=False, pad=True):
+    """
+    Takes one rank's strided share of a list that is identical on every rank, e.g. the batches of
+    SizeBucketBatchSampler; single samples are sharded with torch's DistributedSampler, which pads the same way.
+
+    The remainder of len(items) / num_replicas is dropped, or padded by repeating items from the start of the
+    list, so that every rank gets the same number of items and the ranks stay in lockstep. With neither
+    drop_last nor pad, the first ranks get one item more instead: every item is used exactly once, as for
+    evaluation, but ranks that run collectives per item (e.g. a DistributedDataParallel forward) would hang.
+    """
+    if num_replicas == 1:
+        return items
+    if not (drop_last or pad):
+        return items[rank::num_replicas]
+    per_rank = len(items) // num_replicas if drop_last else -(-len(items) // num_replicas)
+    total = per_rank * num_replicas
+    if items and total > len(items):
+        items = (items * -(-total // len(items)))[:total]
+    return items[rank:total:num_replicas]
+
+def shard_length(num_items, num_replicas, rank, drop_last=False, pad=True):
+    """The length of shard(items, num_replicas, rank, drop_last, pad) for num_items items."""
+    if drop_last:
+        return num_items // num_replicas
+    if pad:
+        return -(-num_items // num_replicas)
+    return len(range(rank, num_items, num_replicas))
+
+class SizeBucketBatchSampler(Sampler):
+    """
+    Batch sampler that only batches scenes of similar size, so batches need little or no padding.
+
+    Scenes are bucketed by their height and width rounded up to bucket_multiple (1 buckets exact shapes) and
+    every batch is drawn from one bucket. Use it with collate_fn=pad_collate (or BatchAugment(...).collate),
+    which pads each batch to its own largest scene, at most the bucket's rounded size.
+
+    Args:
+        shapes (np.ndarray): (N, 2) height and width of every scene, e.g. from load_scene_shapes.
+        batch_size (int): Maximum number of scenes per batch. The last batch of a bucket may be smaller.
+        bucket_multiple (int): Granularity of the buckets in pixels.
+        shuffle (bool): Shuffle the scenes within every bucket and the order of the batches on every pass.
+            Without shuffling, the buckets (by their first scene) and the scenes within them are in dataset order.
+        drop_last (bool): Drop the last, smaller batch of every bucket, and the remainder of the batches when
+            sharding across ranks instead of padding it.
+        num_replicas (int, optional): Number of processes sharing the dataset; each gets a shard of the batches,
+            see shard. Defaults to the torch.distributed world size, or 1.
+        rank (int, optional): This process's rank.
+        seed (int, optional): Draw the shuffle from seed + epoch (see set_epoch) instead of the global RNG, so it
+            is reproducible. Required when shuffling across several ranks, which must all draw the same batches.
+        pad (bool): Pad the remainder of the batches if not dropped; without it every batch is used exactly
+            once across the ranks, as for evaluation, see shard.
+    """
+    def __init__(self, shapes, batch_size, bucket_multiple=1, shuffle=True, drop_last=False, num_replicas=None,
+                 rank=None, seed=None, pad=True):
+        shapes = np.asarray(shapes).reshape(-1, 2)
+        keys = -(-shapes // bucket_multiple)
+        _, bucket_ids = np.unique(keys, axis=0, return_inverse=True)
+        self.buckets = [np.flatnonzero(bucket_ids.ravel() == b) for b in range(bucket_ids.max() + 1)] if len(shapes) else []
+        self.buckets.sort(key=lambda bucket: bucket[0])
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas, self.rank = resolve_shard(num_replicas, rank)
+        if shuffle and seed is None and self.num_replicas > 1:
+            raise ValueError("Shuffling across several ranks needs a seed, so that all ranks draw the same batches")
+        self.seed = seed
+        self.pad = pad
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """Selects the shuffle of an epoch when a seed is set; must be called with the same epoch on every rank."""
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = None
+        if self.shuffle and self.seed is not None:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = bucket[torch.randperm(len(bucket), generator=generator).numpy()]
+            stop = len(bucket) - len(bucket) % self.batch_size if self.drop_last else len(bucket)
+            batches += [bucket[i:i + self.batch_size].tolist() for i in range(0, stop, self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return iter(shard(batches, self.num_replicas, self.rank, self.drop_last, self.pad))
+
+    def __len__(self):
+        if self.drop_last:
+            num_batches = sum(len(bucket) // self.batch_size for bucket in self.buckets)
+        else:
+            num_batches = sum(-(-len(bucket) // self.batch_size) for bucket in self.buckets)
+        return shard_length(num_batches, self.num_replicas, self.rank, self.drop_last, self.pad)
+
+class DevicePrefetcher:
+    """
+    Iterates a DataLoader one or more batches ahead, so getting the next batch onto the device overlaps the current step.
+
+    On CUDA the next batch is pinned (a no-op if the DataLoader already pins with pin_memory=True) and copied
+    with non-blocking transfers on a side stream while the current step runs; the compute stream only waits
+    for that copy when the batch is handed out. On other devices a background thread fetches the next batches
+    into a small queue instead, which overlaps loading and collation with the current step.
+
+    Args:
+        dataloader (DataLoader): Loader yielding tuples or lists of tensors, e.g. (images, labels).
+        device (torch.device): Device the batches are moved to.
+        depth (int): Number of batches the background thread fetches ahead.
+    """
+    def __init__(self, dataloader, device, depth=2):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._cuda_iter()
+        return self._thread_iter()
+
+    def _to_device(self, batch, non_blocking=False):
+        return type(batch)(t.to(self.device, non_blocking=non_blocking) if torch.is_tensor(t) else t for t in batch)
+
+    def _cuda_iter(self):
+        stream = torch.cuda.Stream(self.device)
+
+        def stage(batch):
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                batch = type(batch)(t.pin_memory() if torch.is_tensor(t) else t for t in batch)
+                return self._to_device(batch, non_blocking=True)
+
+        iterator = iter(self.dataloader)
+        staged = stage(next(iterator, None))
+        while staged is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            for t in staged:
+                if torch.is_tensor(t):
+                    t.record_stream(current_stream) # The side stream's allocation is now used by the compute stream
+            batch = staged
+            staged = stage(next(iterator, None)) # Queue the next copy before the caller launches this step's kernels
+            yield batch
+
+    def _thread_iter(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            # Gives up when the consumer stopped early, so the thread never blocks on a full queue forever
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch():
+            try:
+                for batch in self.dataloader:
+                    if not put(("batch", self._to_device(batch))):
+                        return
+                put(("done", None))
+            except Exception as e:
+                put(("error", e))
+
+        thread = threading.Thread(target=fetch, daemon=True)
+        thread.start()
+        try:
+            while True:
+                kind, item = batches.get()
+                if kind == "done":
+                    return
+                if kind == "error":
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
 def compute_segmentation_metrics(preds, labels, eps=1e-6):
     """
     Computes various segmentation metrics for binary segmentation:
@@ -136,7 +1204,8 @@ def compute_segmentation_metrics(preds, labels, eps=1e-6):
 
     Args:
         preds (torch.Tensor): Predicted segmentation masks (H x W) with values 0 or 1.
-        labels (torch.Tensor): Ground truth masks (H x W) with values 0 or 1.
+        labels (torch.Tensor): Ground truth masks (H x W) with values 0 or 1. PAD_LABEL pixels are in none
+            of the counts below.
         eps (float): A small value to avoid division by zero.
 
     Returns:
@@ -163,7 +1232,46 @@ def compute_segmentation_metrics(preds, labels, eps=1e-6):
 
     return {"IoU": iou, "Dice": dice, "FPR": fpr}
 
-def train_one_epoch(model, dataloader, optimizer, criterion, device):
+def amp_dtype(device):
+    """
+    The reduced precision used by mixed-precision training on a device: float16 on CUDA, bfloat16 elsewhere.
+    """
+    return torch.float16 if torch.device(device).type == 'cuda' else torch.bfloat16
+
+def make_grad_scaler(device, amp=False):
+    """
+    Creates the gradient scaler that float16 mixed precision needs to keep small gradients from underflowing.
+
+    Returns:
+        GradScaler or None: None unless amp is enabled and the training runs in float16 (CUDA).
+    """
+    if amp and amp_dtype(device) == torch.float16:
+        return torch.amp.GradScaler(torch.device(device).type)
+    return None
+
+def optimizer_step(model, optimizer, scaler=None, accumulated=1):
+    """
+    Applies the gradients accumulated since the last step and clears them.
+
+    Args:
+        accumulated (int): Number of batches whose (mean) gradients were summed; they are averaged before the step.
+    """
+    if scaler is not None:
+        scaler.unscale_(optimizer)
+    if accumulated > 1:
+        for param in model.parameters():
+            if param.grad is not None:
+                param.grad.div_(accumulated)
+    if scaler is not None:
+        # Steps with inf/NaN gradients are skipped and the scale is lowered
+        scaler.step(optimizer)
+        scaler.update()
+    else:
+        optimizer.step()
+    optimizer.zero_grad()
+
+def train_one_epoch(model, dataloader, optimizer, criterion, device, amp=False, scaler=None, micro_batch_size=None,
+                    accumulation_steps=1, log_interval=None, transform=None):
     """
     Trains the model for one epoch.
 
@@ -173,27 +1281,74 @@ def train_one_epoch(model, dataloader, optimizer, criterion, device):
         optimizer (Optimizer): The optimizer used for updating model parameters.
         criterion (nn.Module): The loss function.
         device (torch.device): The device (CPU or GPU) to use for training.
+        amp (bool): Run the forward pass and loss under autocast (mixed precision, see amp_dtype). The
+            weights, optimizer state and loss reductions stay in float32.
+        scaler (GradScaler, optional): Gradient scaler for float16, see make_grad_scaler. Pass the same one
+            every epoch, it adapts its scale over training.
+        micro_batch_size (int, optional): Run the forward and backward passes on chunks of at most this many
+            samples of each batch, summing their gradients, so that batches too big for memory can be used. The
+            gradient equals the whole batch's up to per-chunk normalisation: each chunk's loss is its own mean
+            (over the pixels not labelled PAD_LABEL, and Dice over the chunk), weighted by its share of the
+            samples, and BatchNorm normalises each chunk separately.
+        accumulation_steps (int): Number of batches whose gradients are averaged into one optimizer step, for an
+            effective batch size of accumulation_steps times the loader's. A shorter last group is stepped too.
+            As with micro_batch_size, the result equals one large batch up to per-batch normalisation.
+            For a DistributedDataParallel model, gradients are only all-reduced by the backward pass before each
+            step, so every rank's loader must yield the same number of batches (see shard).
+        log_interval (int, optional): Print the running average loss every this many batches (on rank 0). The loss
+            is summed on the device and only read back then and at the end of the epoch, since every read waits
+            for the device to finish the queued work.
+        transform (callable, optional): Applied to every (images, labels) batch on the device after the cast to
+            float, e.g. NormalizeBands, so the DataLoader workers can hand over the stored dtype.
 
     Returns:
         float: The average loss for the epoch.
     """
     model.train()
-    running_loss = 0.0
-    for images, labels in dataloader:
-        images = images.to(device)
-        labels = labels.to(device)
-
-        optimizer.zero_grad()
-        outputs = model(images)
-        loss = criterion(outputs, labels)
-        loss.backward()
-        optimizer.step()
-
-        running_loss += loss.item() * images.size(0)
-    epoch_loss = running_loss / len(dataloader.dataset)
+    running_loss = torch.zeros((), dtype=torch.float64, device=device) # Summed on the device, without a host sync per step
+    samples = 0
+    accumulated = 0
+    device_type = torch.device(device).type
+    num_batches = len(dataloader)
+    optimizer.zero_grad()
+    for batch_idx, (images, labels) in enumerate(DevicePrefetcher(dataloader, device)):
+        images = images.float()
+        if transform:
+            images, labels = transform(images, labels)
+        batch_size = images.size(0)
+        chunk = micro_batch_size or batch_size
+        chunks = list(zip(images.split(chunk), labels.split(chunk)))
+        steps_after = accumulated + 1 == accumulation_steps or batch_idx == num_batches - 1
+
+        for chunk_idx, (micro_images, micro_labels) in enumerate(chunks):
+            # A DistributedDataParallel model all-reduces the gradients in the last backward pass before a step only
+            sync = steps_after and chunk_idx == len(chunks) - 1
+            with contextlib.nullcontext() if sync or not hasattr(model, 'no_sync') else model.no_sync():
+                with torch.autocast(device_type, dtype=amp_dtype(device), enabled=amp):
+                    outputs = model(micro_images)
+                    loss = criterion(outputs, micro_labels)
+                # Weight each chunk's mean loss by its share of the batch's samples, so the summed gradients average the chunks
+                weighted_loss = loss * (micro_images.size(0) / batch_size)
+                if scaler is not None:
+                    # Scale the loss so float16 gradients do not underflow
+                    scaler.scale(weighted_loss).backward()
+                else:
+                    weighted_loss.backward()
+            running_loss += loss.detach().double() * micro_images.size(0)
+
+        samples += batch_size
+        accumulated += 1
+        if accumulated == accumulation_steps:
+            optimizer_step(model, optimizer, scaler, accumulated)
+            accumulated = 0
+        if log_interval and (batch_idx + 1) % log_interval == 0 and is_main_process():
+            print(f"  Batch {batch_idx+1}/{num_batches} - Train Loss: {running_loss.item() / samples:.4f}")
+    if accumulated:
+        optimizer_step(model, optimizer, scaler, accumulated)
+    epoch_loss = running_loss.item() / samples
     return epoch_loss
 
-def test_one_epoch(model, dataloader,criterion, device):
+def test_one_epoch(model, dataloader,criterion, device, transform=None):
   """
   Evaluates the model for one epoch on the test dataset.
 
@@ -202,25 +1357,28 @@ def test_one_epoch(model, dataloader,criterion, device):
     dataloader (DataLoader): The data loader for the test dataset.
     criterion (nn.Module): The loss function.
     device (torch.device): The device (CPU or GPU) to use for evaluation.
+    transform (callable, optional): Applied to every (images, labels) batch on the device after the cast to
+        float, e.g. NormalizeBands, so the DataLoader workers can hand over the stored dtype.
 
   Returns:
     float: The average loss for the epoch.
   """
   model.eval()
-  running_loss = 0.0
+  running_loss = torch.zeros((), dtype=torch.float64, device=device) # Summed on the device, read back once per epoch
   with torch.no_grad():
-    for images, labels in dataloader:
-      images = images.to(device)
-      labels = labels.to(device)
+    for images, labels in DevicePrefetcher(dataloader, device):
+      images = images.float()
+      if transform:
+          images, labels = transform(images, labels)
 
       outputs = model(images)
       loss = criterion(outputs, labels)
 
-      running_loss += loss.item() * images.size(0)
-  epoch_loss = running_loss / len(dataloader.dataset)
+      running_loss += loss.double() * images.size(0)
+  epoch_loss = running_loss.item() / len(dataloader.dataset)
   return epoch_loss
 
-def evaluate(model, dataloader, device):
+def evaluate(model, dataloader, device, transform=None):
     """
     Evaluates the model on the given dataset and computes segmentation metrics.
 
@@ -228,6 +1386,7 @@ def evaluate(model, dataloader, device):
         model (nn.Module): The model to evaluate.
         dataloader (DataLoader): The data loader for the evaluation dataset.
         device (torch.device): The device (CPU or GPU) to use for evaluation.
+        transform (callable, optional): Applied to every batch on the device, see train_one_epoch.
 
     Returns:
         dict: A dictionary containing the average IoU, Dice, and FPR metrics.
@@ -235,9 +1394,10 @@ def evaluate(model, dataloader, device):
     model.eval()
     all_metrics = {"IoU": [], "Dice": [], "FPR": []}
     with torch.no_grad():
-        for images, labels in dataloader:
-            images = images.to(device)
-            labels = labels.to(device)
+        for images, labels in DevicePrefetcher(dataloader, device):
+            images = images.float()
+            if transform:
+                images, labels = transform(images, labels)
 
             outputs = model(images)
             preds = torch.argmax(outputs, dim=1)
@@ -261,15 +1421,17 @@ class DiceLoss(nn.Module):
         """
         Args:
             logits (torch.Tensor): Raw outputs from the network with shape [B, 2, H, W].
-            targets (torch.Tensor): Ground truth masks with shape [B, H, W] (values 0 or 1).
+            targets (torch.Tensor): Ground truth masks with shape [B, H, W] (values 0 or 1, PAD_LABEL for padding).
         Returns:
             torch.Tensor: Dice loss.
         """
-        # Compute probabilities via softmax
-        probs = F.softmax(logits, dim=1)
+        # Compute probabilities via softmax, in float32 under mixed precision so the sums below do not lose precision
+        probs = F.softmax(logits.float(), dim=1)
 
-        plume_probs = probs[:, 1, :, :]
-        targets = targets.float()
+        # Padded pixels count towards neither the prediction nor the target
+        valid = targets != PAD_LABEL
+        plume_probs = probs[:, 1, :, :] * valid
+        targets = (targets == 1).float()
 
         # Compute intersection and union per image
         intersection = (plume_probs * targets).sum(dim=(1,2))
@@ -282,7 +1444,7 @@ class CombinedLoss(nn.Module):
     def __init__(self, weight_dice=1.0, weight_ce=1.0, eps=1e-6):
         super().__init__()
         self.dice_loss = DiceLoss(eps)
-        self.ce_loss = nn.CrossEntropyLoss()
+        self.ce_loss = nn.CrossEntropyLoss(ignore_index=PAD_LABEL)
         self.weight_dice = weight_dice
         self.weight_ce = weight_ce
 
@@ -290,15 +1452,187 @@ class CombinedLoss(nn.Module):
         """
         Args:
             logits (torch.Tensor): Raw model outputs with shape [B, 2, H, W].
-            targets (torch.Tensor): Ground truth masks with shape [B, H, W].
+            targets (torch.Tensor): Ground truth masks with shape [B, H, W]. PAD_LABEL pixels are ignored.
         Returns:
             torch.Tensor: Combined loss.
         """
         loss_dice = self.dice_loss(logits, targets)
-        loss_ce = self.ce_loss(logits, targets)
+        loss_ce = self.ce_loss(logits, targets.long()) # Labels may arrive as uint8, CE needs int64
         return self.weight_dice * loss_dice + self.weight_ce * loss_ce
 
-def main_train(train_csv, test_csv, train_loader,test_loader,optimizer, model, num_epochs=10, batch_size=2, device='cuda'):
+def plume_capture(pred, label, plume_index=None, image_id=None):
+    """
+    Counts the plumes (connected components) of a label and how many of them a prediction captures.
+
+    A plume is captured if any of its pixels is predicted as plume.
+
+    Args:
+        pred (np.ndarray): Predicted mask (H x W) with values 0 or 1, possibly padded at the bottom and right.
+        label (np.ndarray): Ground truth mask of the same shape, PAD_LABEL where padded.
+        plume_index (PlumeIndex, optional): Precomputed plumes, used instead of running ndimage.label.
+        image_id (str, optional): Scene ID of the sample, needed with plume_index.
+
+    Returns:
+        tuple: (captured plumes, plumes).
+    """
+    if plume_index is not None:
+        _, _, pixels, starts = plume_index.components(image_id)
+        if not len(starts):
+            return 0, 0
+        # The indexed pixels are flat indices into the unpadded scene
+        row = plume_index.row[image_id]
+        pred = pred[:plume_index.data['height'][row], :plume_index.data['width'][row]]
+        hits = np.ascontiguousarray(pred).ravel()[pixels] == 1
+        return int(np.logical_or.reduceat(hits, starts).sum()), len(starts)
+
+    labeled_plumes, num_plumes = ndimage.label(label == 1) # Not the PAD_LABEL padding
+    captured = np.unique(labeled_plumes[(pred == 1) & (labeled_plumes > 0)])
+    return len(captured), num_plumes
+
+# Fields of the totals accumulated by validate; all are sums, so the totals of several processes can simply be added
+VALIDATION_TOTALS = ["loss", "samples", "IoU", "Dice", "FPR", "TP", "FP", "FN", "TN", "captured_plumes", "plumes"]
+
+def validate(model, dataloader, criterion, device, plume_index=None, transform=None):
+    """
+    Computes the test loss, the segmentation metrics and the plume capture from one forward pass per batch.
+
+    Replaces running test_one_epoch and evaluate over the same loader, which infers every sample twice. In a
+    distributed run every rank must call it; each validates its own shard of the loader (best unpadded, see
+    shard) and the totals are summed over the ranks, so all ranks return the metrics of the whole dataset.
+    Pass the bare model, not its DistributedDataParallel wrapper, so the forward passes run no collectives.
+
+    Args:
+        model (nn.Module): The neural network model.
+        dataloader (DataLoader): The data loader for the test dataset.
+        criterion (nn.Module): The loss function.
+        device (torch.device): The device (CPU or GPU) to use for evaluation.
+        plume_index (PlumeIndex, optional): Precomputed plumes of the dataset's labels, see evaluate_plume_metrics.
+        transform (callable, optional): Applied to every batch on the device, see train_one_epoch.
+
+    Returns:
+        dict: "Loss" averaged over the samples as in test_one_epoch; "IoU", "Dice" and "FPR" averaged over the
+            samples as in evaluate; and "F1", "Pixel FPR" and "Captured Plumes (%)" over all pixels and plumes
+            as in evaluate_plume_metrics.
+    """
+    return validation_metrics(all_reduce_sum(validation_totals(model, dataloader, criterion, device, plume_index, transform), device))
+
+def validation_totals(model, dataloader, criterion, device, plume_index=None, transform=None):
+    """
+    Accumulates the sums behind validate's metrics, see VALIDATION_TOTALS.
+
+    Returns:
+        np.ndarray: float64 totals, in VALIDATION_TOTALS order.
+    """
+    model.eval()
+    eps = 1e-6
+    device_totals = torch.zeros(9, dtype=torch.float64, device=device) # Up to TN, kept on the device
+    captured_plumes, plumes = 0, 0
+    if plume_index is not None:
+        order = batch_order(dataloader)
+        sample_ids = dataloader.dataset.ids[order]
+    sample_idx = 0
+
+    with torch.no_grad():
+        for images, labels in DevicePrefetcher(dataloader, device):
+            images = images.float()
+            if transform:
+                images, labels = transform(images, labels)
+            outputs = model(images)
+            loss = criterion(outputs, labels)
+            preds = torch.argmax(outputs, dim=1)
+
+            # Per-sample confusion counts for the whole batch at once; PAD_LABEL pixels are in none of them
+            pred_plume, label_plume, label_background = preds == 1, labels == 1, labels == 0
+            tp = (pred_plume & label_plume).sum(dim=(1, 2)).double()
+            fp = (pred_plume & label_background).sum(dim=(1, 2)).double()
+            fn = (~pred_plume & label_plume).sum(dim=(1, 2)).double()
+            tn = (~pred_plume & label_background).sum(dim=(1, 2)).double()
+            batch_size = images.size(0)
+            device_totals += torch.stack([
+                loss.detach().double() * batch_size,
+                torch.tensor(batch_size, dtype=torch.float64, device=device),
+                (tp / (tp + fp + fn + eps)).sum(),
+                (2 * tp / (2 * tp + fp + fn + eps)).sum(),
+                (fp / (fp + tn + eps)).sum(),
+                tp.sum(), fp.sum(), fn.sum(), tn.sum(),
+            ])
+
+            preds_np = preds.cpu().numpy().astype(np.uint8)
+            labels_np = labels.cpu().numpy().astype(np.uint8)
+            for b in range(batch_size):
+                image_id = sample_ids[sample_idx] if plume_index is not None else None
+                sample_idx += 1
+                captured, num_plumes = plume_capture(preds_np[b], labels_np[b], plume_index, image_id)
+                captured_plumes += captured
+                plumes += num_plumes
+
+    return np.concatenate([device_totals.cpu().numpy(), [captured_plumes, plumes]])
+
+def validation_metrics(totals, eps=1e-6):
+    """
+    Turns the totals of validation_totals (possibly summed over several processes) into validate's metrics.
+    """
+    t = dict(zip(VALIDATION_TOTALS, (float(total) for total in totals)))
+    samples = max(t["samples"], 1)
+    return {
+        "Loss": t["loss"] / samples,
+        "IoU": t["IoU"] / samples,
+        "Dice": t["Dice"] / samples,
+        "FPR": t["FPR"] / samples,
+        "F1": 2.0 * t["TP"] / (2.0 * t["TP"] + t["FP"] + t["FN"] + eps),
+        "Pixel FPR": t["FP"] / (t["FP"] + t["TN"] + eps),
+        "Captured Plumes (%)": t["captured_plumes"] / (t["plumes"] + eps) * 100.0,
+    }
+
+def setup_distributed(backend=None):
+    """
+    Joins the process group of a multi-process launch and picks this process's device.
+
+    A launch such as `torchrun --nnodes=N --nproc_per_node=G train_distributed.py --model ...` starts one process
+    per rank and sets RANK, LOCAL_RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT; without WORLD_SIZE in the
+    environment this is a single-process run and no process group is created. This notebook cannot be launched
+    itself, as it installs packages, mounts Drive and reads /content paths; train_distributed.py runs only its
+    definitions. Call it before building the samplers, which shard the
+    data by the process group (see resolve_shard).
+
+    Args:
+        backend (str, optional): torch.distributed backend; "nccl" with GPUs and "gloo" (CPU) otherwise.
+
+    Returns:
+        torch.device: cuda:LOCAL_RANK with GPUs, else cpu.
+    """
+    if torch.cuda.is_available():
+        device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device("cpu")
+    if "WORLD_SIZE" in os.environ and not dist.is_initialized():
+        dist.init_process_group(backend or ("nccl" if device.type == "cuda" else "gloo"))
+    return device
+
+def is_main_process():
+    """True on rank 0, and in a single-process run; only it logs and saves checkpoints."""
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+def all_reduce_sum(values, device):
+    """
+    Sums an array of totals over all ranks; returns it unchanged in a single-process run.
+
+    Args:
+        values (array-like): Totals of this rank, the same length on every rank.
+        device (torch.device): Device of this rank (NCCL reduces CUDA tensors only).
+
+    Returns:
+        np.ndarray: float64 totals of all ranks.
+    """
+    if not (dist.is_available() and dist.is_initialized()):
+        return np.asarray(values, dtype=np.float64)
+    tensor = torch.as_tensor(np.asarray(values, dtype=np.float64), device=device)
+    dist.all_reduce(tensor)
+    return tensor.cpu().numpy()
+
+def main_train(train_csv, test_csv, train_loader,test_loader,optimizer, model, num_epochs=10, batch_size=2, device='cuda', plume_index=None, amp=False, micro_batch_size=None,
+               accumulation_steps=1, log_interval=None, transform=None, checkpoint_dir="/content/drive/MyDrive/ClimateChange/"):
     """
     Trains the UNet model for a specified number of epochs.
 
@@ -313,6 +1647,18 @@ def main_train(train_csv, test_csv, train_loader,test_loader,optimizer, model, n
         batch_size (int): The batch size for training and testing.
         lr (float): The learning rate.
         device (str): The device to use for training ('cuda' or 'cpu').
+        plume_index (PlumeIndex, optional): Precomputed plumes of the test labels, for the plume capture metric.
+        amp (bool): Train with mixed precision, see train_one_epoch.
+        micro_batch_size (int, optional): Split every batch into chunks of this size for the forward and backward
+            passes, see train_one_epoch.
+        accumulation_steps (int): Average the gradients of this many batches per optimizer step.
+        log_interval (int, optional): Also print the running training loss every this many batches.
+        transform (callable, optional): Applied to every training and test batch on the device, e.g. NormalizeBands.
+        checkpoint_dir (str): Directory the state dict is saved to every 5 epochs.
+
+    In a distributed run (see setup_distributed), every rank calls it with its own loaders: the model is
+    trained as a DistributedDataParallel replica, losses and metrics are reduced over the ranks, and only
+    rank 0 prints and saves checkpoints.
 
     Returns:
         nn.Module: The trained UNet model.
@@ -320,32 +1666,60 @@ def main_train(train_csv, test_csv, train_loader,test_loader,optimizer, model, n
     # Initialize the combined loss function with weights for Dice and Cross-Entropy loss
     criterion = CombinedLoss(weight_dice=1.0, weight_ce=1.0)
 
+    # With several processes, train a DistributedDataParallel replica that all-reduces the gradients, but
+    # validate the bare model, whose forward runs no collectives, on every rank's shard of the test data
+    device = torch.device(device)
+    train_model = model
+    if dist.is_available() and dist.is_initialized():
+        train_model = nn.parallel.DistributedDataParallel(model, device_ids=[device] if device.type == 'cuda' else None)
+
+    # Gradient scaler for float16 mixed precision (None on CPU, where bfloat16 needs none), kept across epochs
+    scaler = make_grad_scaler(device, amp)
+
     # Create a learning rate scheduler that reduces the learning rate on plateau (when validation loss stops improving)
     scheduler = ReduceLROnPlateau(
       optimizer,
       mode='min',
       factor=0.5,
       patience=5,
-      threshold=1e-4,
-      verbose=True)
+      threshold=1e-4)
 
     for epoch in range(num_epochs):
+        # Samplers such as DistributedSampler draw a new, reproducible shuffle per epoch
+        for sampler in (train_loader.sampler, train_loader.batch_sampler):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
         # Train the model for one epoch and get the training loss
-        train_loss = train_one_epoch(model, train_loader, optimizer, criterion, device)
-        # Evaluate the model on the test dataset and get segmentation metrics (IoU, Dice, FPR)
-        metrics = evaluate(model, test_loader, device)
-        # Test the model for one epoch and get the test loss
-        test_loss = test_one_epoch(model, test_loader, criterion, device)
-
-        print(f"Epoch {epoch+1}/{num_epochs} - Train Loss: {train_loss:.4f}; Test Loss: {test_loss:.4f} - Metrics: {metrics}")
-
-        # Step the learning rate scheduler based on the test loss
+        train_loss = train_one_epoch(train_model, train_loader, optimizer, criterion, device, amp=amp, scaler=scaler,
+                                     micro_batch_size=micro_batch_size, accumulation_steps=accumulation_steps,
+                                     log_interval=log_interval, transform=transform)
+        # Average the training loss over the ranks, which train the same number of batches
+        loss_sum, ranks = all_reduce_sum([train_loss, 1], device)
+        train_loss = loss_sum / ranks
+        if train_model is not model:
+            # DDP only copies rank 0's buffers (BatchNorm statistics) at the start of each forward pass; copy the
+            # ones of the last pass too, so that every rank validates the model rank 0 saves
+            for buffer in model.buffers():
+                dist.broadcast(buffer, 0)
+        # Get the test loss and the segmentation metrics (IoU, Dice, FPR, plume capture) from one pass over the test dataset
+        metrics = validate(model, test_loader, criterion, device, plume_index, transform)
+        test_loss = metrics.pop("Loss")
+
+        if is_main_process():
+
+            print(f"Epoch {epoch+1}/{num_epochs} - Train Loss: {train_loss:.4f}; Test Loss: {test_loss:.4f} - Metrics: {metrics}")
+
+        # Step the learning rate scheduler based on the test loss (its verbose option is gone from recent torch)
+        lr = optimizer.param_groups[0]['lr']
         scheduler.step(test_loss)
+        if optimizer.param_groups[0]['lr'] < lr and is_main_process():
+            print(f"Reducing learning rate to {optimizer.param_groups[0]['lr']:.2e}")
 
         # Save the model's state dictionary every 5 epochs
-        if (epoch+1) % 5 == 0:
+        if (epoch+1) % 5 == 0 and is_main_process():
+          os.makedirs(checkpoint_dir, exist_ok=True)
           model_path = os.path.join(
-              "/content/drive/MyDrive/ClimateChange/",
+              checkpoint_dir,
               f"epoch_{epoch+1}_Unet_V2.pth"
           )
           torch.save(model.state_dict(), model_path)
@@ -353,7 +1727,8 @@ def main_train(train_csv, test_csv, train_loader,test_loader,optimizer, model, n
 
     return model
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# One process per GPU (or CPU) when launched with torchrun, else a single process on the default device
+device = setup_distributed()
 # Set the learning rate for the optimizer.
 lr = 1e-4
 
@@ -363,37 +1738,72 @@ model = UNet(c_in=9, c_out=2, base_channels=128).to(device)
 # Initialize the Adam optimizer for training the model.
 optimizer = optim.Adam(model.parameters(), lr=lr)
 
-#Copying the preprocessed training data to colab local environment to improve speed of training
-shutil.copytree("/content/drive/MyDrive/ClimateChange/preprocessed/STARCOP_train_easy", "/content/STARCOP_train_easy/")
-
-#Copying the preprocessed test data to colab local environment to improve speed of training
-shutil.copytree("/content/drive/MyDrive/ClimateChange/preprocessed/STARCOP_test", "/content/STARCOP_test/")
-
 shutil.copy("/content/drive/MyDrive/ClimateChange/STARCOP_train_easy/train_easy.csv", "/content/train_easy.csv")
 shutil.copy("/content/drive/MyDrive/ClimateChange/STARCOP_test/test.csv", "/content/test.csv")
 
 train_csv ="/content/train_easy.csv"
 test_csv = "/content/test.csv"
-root_dir_train = "/content/STARCOP_train_easy"
-root_dir_test = "/content/STARCOP_test"
+root_dir_train = "/content/drive/MyDrive/ClimateChange/preprocessed/STARCOP_train_easy"
+root_dir_test = "/content/drive/MyDrive/ClimateChange/preprocessed/STARCOP_test"
+
+#The preprocessed data stays on Drive; each file is copied to the colab local environment the first time it is read
+local_ranks = int(os.environ.get("LOCAL_WORLD_SIZE", 1)) # Training processes on this machine, each keeps its own copies
+local_suffix = f"_rank{os.environ.get('LOCAL_RANK', 0)}" if local_ranks > 1 else ""
+local_cache_bytes = 30 * 1024**3 // local_ranks # Local disk used per directory, least recently used files are evicted beyond it
+train_files = LocalFileCache(root_dir_train, "/content/STARCOP_train_easy" + local_suffix, pd.read_csv(train_csv)['id'], local_cache_bytes)
+test_files = LocalFileCache(root_dir_test, "/content/STARCOP_test" + local_suffix, pd.read_csv(test_csv)['id'], local_cache_bytes)
 
 batch_size = 4 #Defining the number of samples in a batch
 
-train_dataset = STARCOPDataset(csv_file=train_csv, preprocessed_dir=root_dir_train) # Create the dataset for training
-test_dataset  = STARCOPDataset(csv_file=test_csv, preprocessed_dir=root_dir_test)  # Create the dataset for testing
+use_normalize = False # Standardise the bands with the training set statistics, on the device (see main_train); checkpoints trained without it expect raw inputs
+normalize = NormalizeBands(os.path.join(root_dir_train, "band_stats.json")) if use_normalize else None
+
+cache_bytes = 0 # Shared-memory budget per dataset, e.g. 8 * 1024**3 // local_ranks, so epochs after the first are served from RAM; both datasets draw on the same /dev/shm
+
+use_patches = False # Train on plume-biased random crops instead of whole scenes (use a learning rate suited to patch_batch_size)
+patch_size = 128 # Side of the training crops, a multiple of 2**depth
+patch_batch_size = 64 # Crops are 16x smaller than 512x512 scenes, so many more fit in a batch
+
+use_augment = False # Augment the training batches with random flips/rotations and a per-band gain
+augment = BatchAugment(p_flip=0.5, p_transpose=0.5, spectral_gain=0.05) # Applied per collated batch
+train_collate = augment.collate if use_augment else pad_collate
+
+use_amp = False # Mixed precision training: float16 on the GPU (bfloat16 on CPU), about half the activation memory
+micro_batch_size = None # Forward/backward each batch in chunks of this many samples when it does not fit in memory
+accumulation_steps = 1 # Batches averaged per optimizer step, for an effective batch size of accumulation_steps * batch size
+log_interval = None # Print the running training loss every this many batches, besides the per-epoch summary
 
-train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=8) #Create a dataloder for training
-test_loader  = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=8) #Create a dataloader for testing
+if use_patches:
+    train_dataset = STARCOPPatchDataset(csv_file=train_csv, preprocessed_dir=root_dir_train, patch_size=patch_size, plume_fraction=0.5, keep_dtypes=True, file_cache=train_files) # Half of the crops contain a plume or mag1c hotspot
+else:
+    train_dataset = STARCOPDataset(csv_file=train_csv, preprocessed_dir=root_dir_train, keep_dtypes=True, cache_bytes=cache_bytes, file_cache=train_files) # Create the dataset for training
+test_dataset  = STARCOPDataset(csv_file=test_csv, preprocessed_dir=root_dir_test, keep_dtypes=True, cache_bytes=cache_bytes, file_cache=test_files)  # Create the dataset for testing
+
+if use_patches:
+    train_loader = DataLoader(train_dataset, batch_size=patch_batch_size, sampler=DistributedSampler(train_dataset, *resolve_shard(), seed=0), num_workers=8, pin_memory=torch.cuda.is_available(), collate_fn=train_collate) #Create a dataloder for training
+else:
+    # Whole scenes differ in size, so only scenes of the same size are batched together
+    train_sampler = SizeBucketBatchSampler(load_scene_shapes(root_dir_train, train_dataset.ids), batch_size, shuffle=True, seed=0)
+    train_loader = DataLoader(train_dataset, batch_sampler=ReadaheadSampler(train_sampler, train_dataset), num_workers=8, pin_memory=torch.cuda.is_available(), collate_fn=train_collate) #Create a dataloder for training
+test_sampler = SizeBucketBatchSampler(load_scene_shapes(root_dir_test, test_dataset.ids), batch_size, shuffle=False, pad=False) # Every scene validated once across the ranks
+test_loader  = DataLoader(test_dataset, batch_sampler=ReadaheadSampler(test_sampler, test_dataset), num_workers=8, pin_memory=torch.cuda.is_available(), collate_fn=pad_collate) #Create a dataloader for testing
 
-#Define device for training
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 #Start training
-trained_model = main_train(train_csv, test_csv, train_loader=train_loader,test_loader=test_loader,optimizer=optimizer, model=model, num_epochs=250, batch_size=batch_size, device=device)
+trained_model = main_train(train_csv, test_csv, train_loader=train_loader,test_loader=test_loader,optimizer=optimizer, model=model, num_epochs=250, batch_size=batch_size, device=device, plume_index=PlumeIndex(os.path.join(root_dir_test, "plume_index.npz")), amp=use_amp, micro_batch_size=micro_batch_size, accumulation_steps=accumulation_steps, log_interval=log_interval, transform=normalize)
+
+# The visualisation and final evaluation below run on rank 0 only
+if dist.is_initialized():
+    main_process = is_main_process()
+    dist.destroy_process_group()
+    if not main_process:
+        raise SystemExit(0)
 
 #Visualise segmentation results on a test image
 image, label = test_dataset[180] # Get the 180th image and label from the test dataset
 
-image_tensor = image.unsqueeze(0).to(device)
+image_tensor = image.unsqueeze(0).to(device).float()
+if normalize:
+    image_tensor, _ = normalize(image_tensor, None)
 model.eval() # Set the model to evaluation mode
 
 # Perform inference without gradient calculation
@@ -421,7 +1831,7 @@ plt.axis("off")
 
 plt.show()
 
-def evaluate_plume_metrics(model, dataloader, device):
+def evaluate_plume_metrics(model, dataloader, device, plume_index=None, strata=None, transform=None):
     """
     Computes F1, FPR, and Captured Plumes metrics across the dataset.
 
@@ -429,23 +1839,37 @@ def evaluate_plume_metrics(model, dataloader, device):
         model (nn.Module): Trained binary segmentation model.
         dataloader (DataLoader): DataLoader for the test dataset.
         device (torch.device): Device to run inference on (CPU or GPU).
+        plume_index (PlumeIndex, optional): Precomputed plumes of the dataset's labels. The dataloader must
+            then iterate the dataset in a fixed order (shuffle=False, also with SizeBucketBatchSampler) so
+            samples can be matched to scene IDs.
+        strata (array-like, optional): Stratum of every sample of the dataset, e.g. the CSV's difficulty
+            column. The metrics of every stratum are then accumulated in the same inference pass as the
+            overall ones. Needs a fixed sample order like plume_index. Strata are compared as strings, and
+            missing ones (NaN or None) are grouped under "unknown".
+        transform (callable, optional): Applied to every batch on the device, see train_one_epoch.
 
     Returns:
-        dict: Metrics with keys "F1", "FPR", "Captured Plumes (%)".
+        dict: Metrics with keys "F1", "FPR", "Captured Plumes (%)". With strata, such metrics under "overall"
+            and under every stratum value that occurs in the dataset.
     """
     model.eval()
     eps = 1e-6
-    total_tp = 0
-    total_fp = 0
-    total_fn = 0
-    total_tn = 0
-    captured_plumes_count = 0
-    total_plumes = 0
+    # TP, FP, FN, TN, captured plumes and plumes of every stratum
+    counts = {}
+    if plume_index is not None or strata is not None:
+        # The order the batch sampler visits the scenes in, which is not dataset order when batches are bucketed by size
+        order = batch_order(dataloader)
+        sample_ids = dataloader.dataset.ids[order]
+        if strata is not None:
+            strata = np.array(["unknown" if pd.isna(stratum) else str(stratum) for stratum in strata], dtype=object)
+        sample_strata = strata[order] if strata is not None else None
+    sample_idx = 0
 
     with torch.no_grad():
-        for images, labels in dataloader:
-            images = images.to(device)
-            labels = labels.to(device)
+        for images, labels in DevicePrefetcher(dataloader, device):
+            images = images.float()
+            if transform:
+                images, labels = transform(images, labels)
             outputs = model(images)
             preds = torch.argmax(outputs, dim=1)
 
@@ -462,56 +1886,48 @@ def evaluate_plume_metrics(model, dataloader, device):
                 fp = np.sum((pred_b == 1) & (label_b == 0)) #False positive
                 fn = np.sum((pred_b == 0) & (label_b == 1)) #False negative
                 tn = np.sum((pred_b == 0) & (label_b == 0)) #True negative
-                total_tp += tp
-                total_fp += fp
-                total_fn += fn
-                total_tn += tn
-
-                # Identify distinct plumes in the ground truth
-                labeled_plumes, num_plumes = ndimage.label(label_b)
-                total_plumes += num_plumes
-                # For each plume, if any pixel in the plume is predicted as plume, count it as captured
-                for pid in range(1, num_plumes + 1):
-                    plume_mask = (labeled_plumes == pid)
-                    if np.any(pred_b[plume_mask] == 1):
-                        captured_plumes_count += 1
-
-    F1 = (2.0 * total_tp) / (2.0 * total_tp + total_fp + total_fn + eps)
-    FPR = total_fp / (total_fp + total_tn + eps)
-    captured_plumes_percent = (captured_plumes_count / (total_plumes + eps)) * 100.0
-
-    return {"F1": F1, "FPR": FPR, "Captured Plumes (%)": captured_plumes_percent}
+
+                # Reuse the plumes found at preprocessing time if there is an index, otherwise find them here
+                image_id = sample_ids[sample_idx] if plume_index is not None else None
+                captured_plumes_count, num_plumes = plume_capture(pred_b, label_b, plume_index, image_id)
+
+                stratum = sample_strata[sample_idx] if strata is not None else None
+                sample_idx += 1
+                if stratum not in counts:
+                    counts[stratum] = np.zeros(6, dtype=np.int64)
+                counts[stratum] += [tp, fp, fn, tn, captured_plumes_count, num_plumes]
+
+    def metrics(c):
+        total_tp, total_fp, total_fn, total_tn, captured_plumes_count, total_plumes = c
+        F1 = (2.0 * total_tp) / (2.0 * total_tp + total_fp + total_fn + eps)
+        FPR = total_fp / (total_fp + total_tn + eps)
+        captured_plumes_percent = (captured_plumes_count / (total_plumes + eps)) * 100.0
+        return {"F1": F1, "FPR": FPR, "Captured Plumes (%)": captured_plumes_percent}
+
+    overall = metrics(sum(counts.values(), np.zeros(6, dtype=np.int64)))
+    if strata is None:
+        return overall
+    return {"overall": overall, **{stratum: metrics(c) for stratum, c in sorted(counts.items())}}
 
 # CSV path and preprocessed directory path
 csv_path = "/content/test.csv"
-preprocessed_dir = "/content/STARCOP_test"
-
-#Filter the test set based on difficulty column
-test_easy_df = test_df[test_df['difficulty'] == 'easy']
-test_hard_df = test_df[test_df['difficulty'] == 'hard']
+preprocessed_dir = root_dir_test
 
-test_df.to_csv("/tmp/test_filtered.csv", index=False)
-test_easy_df.to_csv("/tmp/test_easy.csv", index=False)
-test_hard_df.to_csv("/tmp/test_hard.csv", index=False)
+# Create the dataset object using the preprocessed dataset class
+test_dataset = STARCOPDataset(csv_file=csv_path, preprocessed_dir=preprocessed_dir, file_cache=test_files)
 
-# Create dataset objects using the preprocessed dataset class
-test_dataset = STARCOPDataset(csv_file=csv_path, preprocessed_dir=preprocessed_dir)
-test_easy_dataset = STARCOPDataset(csv_file="/tmp/test_easy.csv", preprocessed_dir=preprocessed_dir)
-test_hard_dataset = STARCOPDataset(csv_file="/tmp/test_hard.csv", preprocessed_dir=preprocessed_dir)
+# Precomputed plumes of the test labels, so evaluation does not rerun ndimage.label
+plume_index = PlumeIndex(os.path.join(preprocessed_dir, "plume_index.npz"))
 
-# Create DataLoaders
-test_loader = DataLoader(test_dataset, batch_size=1, shuffle=False)
-test_easy_loader = DataLoader(test_easy_dataset, batch_size=1, shuffle=False)
-test_hard_loader = DataLoader(test_hard_dataset, batch_size=1, shuffle=False)
+# Create DataLoader
+test_loader = DataLoader(test_dataset, batch_size=1, shuffle=False, pin_memory=torch.cuda.is_available())
 
-# Evaluate metrics on overall test set, and on easy/hard subsets
-overall_metrics = evaluate_plume_metrics(model, test_loader, device)
-easy_metrics = evaluate_plume_metrics(model, test_easy_loader, device)
-hard_metrics = evaluate_plume_metrics(model, test_hard_loader, device)
+# Evaluate metrics on the overall test set and on its easy/hard subsets, stratified by the difficulty column, in one pass
+metrics_by_difficulty = evaluate_plume_metrics(model, test_loader, device, plume_index, strata=pd.read_csv(csv_path)['difficulty'], transform=normalize)
 
 print("Overall Test Metrics:")
-print(overall_metrics)
-print("\nEasy Subset Metrics:")
-print(easy_metrics)
-print("\nHard Subset Metrics:")
-print(hard_metrics)
+print(metrics_by_difficulty.pop("overall"))
+# Only the difficulties that occur in the test set, e.g. easy and hard
+for difficulty, difficulty_metrics in metrics_by_difficulty.items():
+    print(f"\n{difficulty.capitalize()} Subset Metrics:")
+    print(difficulty_metrics)